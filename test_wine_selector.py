@@ -1,8 +1,26 @@
-import wine_selector as ws
+import asyncio
 import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pandas as pd
+import pytest
+import wine_selector as ws
+import wine_selector_service
+from wine_selector_benchmark import WORDS, generate_corpus
+from wine_selector_metrics import RecordingMetrics
+from wine_selector_runtime import WineSelectorRuntime
+from wine_selector_service import (ServiceOverloaded, WineSelectorClient, WineSelectorService,
+                                   _select_batch)
+from wine_selector_utils import WineSelectorUtils
 
 SRC_FILENAME = 'winemag-data-130k-v2.csv'
-DB_FILENAME = 'winemag-data-130k-v2-preprocessed.csv'
+CSV_FILENAME = 'winemag-data-130k-v2-preprocessed.csv'
+DB_FILENAME = 'winemag-data-130k-v2-preprocessed.store'
 
 
 def main():
@@ -16,20 +34,19 @@ def main():
         print("Loading preprocessed data...")
         selector.load_preprocessed_data(DB_FILENAME)
     else:
-        print("Preprocessing data...")
-        selector.preprocess_data(SRC_FILENAME)
+        if os.path.exists(CSV_FILENAME):
+            print("Loading preprocessed CSV data...")
+            selector.load_preprocessed_data(CSV_FILENAME)
+        else:
+            print("Preprocessing data...")
+            selector.preprocess_data(SRC_FILENAME)
         print("Saving preprocessed data...")
         selector.save_preprocessed_data(DB_FILENAME)
 
     df = selector.get_data()
-    print(f"Data shape base:\t{df.shape}")
-    df.drop_duplicates(
-        subset=['title', 'description', 'price', 'points'], inplace=True)
-    print(f"Data shape dropped:\t{df.shape}")
+    print(f"Data shape:\t{df.shape}")
     print(df[df.index == 11]['description'].values[0])
 
-    return
-
     # Select the wine
     request = 'Nice, mild pear taste, hint of vanialla and apple'
     selected_wines = selector.select_wine(
@@ -41,5 +58,690 @@ def main():
     # selected_wines.to_csv('results\\selected_wines.csv', index=False)
 
 
+def make_reviews(path):
+    '''
+    Write a small raw winemag-shaped file and return its name
+    '''
+    rows = [
+        ('Italy', 'Aromas of pear, apple and a hint of vanilla.', 'Vigna',
+         87, 25.0, 'Sicily', 'Etna', None, 'Kerin', '@kerin',
+         'Nicosia 2013 Vigna (Etna)', 'White Blend', 'Nicosia'),
+        ('Portugal', 'Ripe black cherry and firm tannins, juicy and structured.', 'Avidagos',
+         87, 15.0, 'Douro', None, None, 'Roger', '@vossroger',
+         'Quinta dos Avidagos 2011 Avidagos Red (Douro)', 'Portuguese Red', 'Quinta dos Avidagos'),
+        ('US', 'Tart lime and green pineapple with crisp citrus acidity.', None,
+         87, 14.0, 'Oregon', 'Willamette Valley', None, 'Paul', '@paulgwine',
+         'Rainstorm 2013 Pinot Gris (Willamette Valley)', 'Pinot Gris', 'Rainstorm'),
+        (None, 'Strawberry and watermelon, a dry and refreshing pink.', 'Rosé',
+         86, 18.0, 'California', 'Sonoma', None, None, None,
+         'Rainstorm 2015 Rosé (Oregon)', 'Zinfandel', 'Rainstorm'),
+        ('France', 'Fine bubbles with toast, brioche and green apple.', 'Brut',
+         90, 65.0, 'Champagne', 'Champagne', None, 'Roger', '@vossroger',
+         'Maison 2008 Brut (Champagne)', 'Champagne Blend', 'Maison'),
+        ('US', 'Blackberry, plum and vanilla from new oak, velvety and rich.', 'Reserve',
+         91, 80.0, 'California', 'Napa Valley', 'Napa', 'Virginie', '@vboone',
+         'Hills 2014 Reserve Cabernet Sauvignon (Napa Valley)', 'Cabernet Sauvignon', 'Hills'),
+        ('US', 'Blackberry, plum and vanilla from new oak, velvety and rich.', 'Reserve',
+         91, 80.0, 'California', 'Napa Valley', 'Napa', 'Virginie', '@vboone',
+         'Hills 2014 Reserve Cabernet Sauvignon (Napa Valley)', 'Cabernet Sauvignon', 'Hills'),
+        ('Spain', 'Cherry and red plum with soft vanilla and spice.', 'Crianza',
+         88, 22.0, 'Northern Spain', 'Rioja', None, 'Michael', '@wineschach',
+         'Bodega 2012 Crianza (Rioja)', 'Tempranillo', 'Bodega'),
+    ]
+    columns = ['country', 'description', 'designation', 'points', 'price',
+               'province', 'region_1', 'region_2', 'taster_name',
+               'taster_twitter_handle', 'title', 'variety', 'winery']
+    fileName = os.path.join(path, 'reviews.csv')
+    pd.DataFrame(rows, columns=columns).to_csv(fileName)
+    return fileName
+
+
+def test_scores_do_not_depend_on_chunk_size(tmp_path):
+    '''
+    The corpus index is fitted once, so chunking must not change the scores
+    '''
+    src = make_reviews(tmp_path)
+    request = 'pear and vanilla'
+
+    small = ws.WineSelector(chunk_size=2, n_similar=8)
+    small.preprocess_data(src)
+    large = ws.WineSelector(chunk_size=100, n_similar=8)
+    large.preprocess_data(src)
+
+    small_scores = small.select_wine(request)['score'].sort_index()
+    large_scores = large.select_wine(request)['score'].sort_index()
+    pd.testing.assert_series_equal(small_scores, large_scores)
+    assert small.select_wine(request).index[0] == 0
+
+
+def test_global_top_k_is_chunk_independent(tmp_path):
+    '''
+    Exactly n_similar wines are returned whatever the chunk size
+    '''
+    src = make_reviews(tmp_path)
+    results = []
+    for chunk_size in (1, 3, 100):
+        selector = ws.WineSelector(chunk_size=chunk_size, n_similar=3)
+        selector.preprocess_data(src)
+        results.append(selector.select_wine('blackberry plum vanilla oak'))
+
+    assert len(results[0]) == 3
+    for result in results[1:]:
+        pd.testing.assert_frame_equal(results[0], result)
+
+
+def test_select_wines_matches_select_wine(tmp_path):
+    '''
+    The batch API returns the same wines as one select_wine call per request
+    '''
+    selector = ws.WineSelector(chunk_size=3, n_similar=2)
+    selector.preprocess_data(make_reviews(tmp_path))
+
+    requests = ['pear and vanilla', 'cherry plum spice', 'bubbles and toast']
+    type_filters = [None, ['red'], None]
+    price_filters = [None, None, [20, 70]]
+    batch = selector.select_wines(requests, type_filters, price_filters,
+                                  batch_size=2)
+
+    assert list(batch['request']) == [0, 0, 1, 1, 2, 2]
+    for request_id, request in enumerate(requests):
+        single = selector.select_wine(request, type_filter=type_filters[request_id],
+                                      price_filter=price_filters[request_id])
+        result = batch[batch['request'] == request_id]
+        assert list(result.index) == list(single.index)
+        assert list(result['score']) == pytest.approx(list(single['score']))
+
+    empty = selector.select_wines([])
+    assert empty.empty and list(empty.columns) == list(batch.columns)
+    with pytest.raises(ValueError):
+        selector.select_wines(requests, type_filters=[None])
+    with pytest.raises(ValueError):
+        selector.select_wines(requests, price_filters=price_filters + [None])
+
+
+def test_filters_match_dataframe_masks(tmp_path):
+    '''
+    The precomputed type and price indexes select the same wines as masking
+    the dataframe
+    '''
+    src = make_reviews(tmp_path)
+    selector = ws.WineSelector(chunk_size=3, n_similar=12)
+    selector.preprocess_data(src)
+
+    # The indexes are extended with the added reviews
+    new_reviews = pd.read_csv(src, index_col=0).iloc[[1, 4, 7, 2]].set_axis([100, 101, 102, 103])
+    new_reviews['price'] = [22.0, 15.0, None, 80.0]
+    new_reviews['description'] += ' Again.'
+    for step in range(2):
+        if step:
+            selector.add_reviews(new_reviews)
+        df = selector.get_data()
+        for type_filter, price_filter in [(['red', 'rose'], None), (None, [15, 25]),
+                                          (['white'], [10, 30]), (['orange'], None)]:
+            mask = pd.Series(True, index=df.index)
+            if type_filter:
+                mask &= df['type'].isin(type_filter)
+            if price_filter:
+                mask &= (df['price'] >= price_filter[0]) & (df['price'] <= price_filter[1])
+
+            result = selector.select_wine('fruit', type_filter=type_filter,
+                                          price_filter=price_filter)
+            assert sorted(result.index) == sorted(df.index[mask])
+
+
+def test_assign_wine_types_parity():
+    '''
+    The vectorized wine type assignment gives the same types as the row by
+    row reference implementation
+    '''
+    utils = WineSelectorUtils()
+    varieties = [item.title() for items in utils.get_wine_types().values()
+                 for item in items] + ['Zinfandel', 'Primitivo', 'Unknown Grape']
+    rng = random.Random(0)
+    rows = []
+    for cnt in range(600):
+        variety = rng.choice(varieties)
+        designation = rng.choice(
+            [None, 'Reserve', 'White Zinfandel', 'Rosé', rng.choice(varieties)])
+        title = f'Winery {cnt} 2015 {rng.choice(["", "Brut ", designation or ""])}({variety})'
+        rows.append({'designation': designation, 'title': title, 'variety': variety})
+
+    fast = utils.assign_wine_types(pd.DataFrame(rows))
+    slow = utils.assign_wine_types_slow(pd.DataFrame(rows))
+    assert list(fast['type']) == list(slow['type'])
+
+
+def test_country_fill_by_title_prefix():
+    '''
+    Null countries are filled from the other wines with the same title prefix,
+    regex metacharacters in the titles are taken literally
+    '''
+    utils = WineSelectorUtils()
+    df = pd.DataFrame({
+        'title': ['Rainstorm 2013 Pinot Gris', 'rainstorm 2015 Rosé', 'A+B (Cellars) 2014 Red',
+                  'A+B (Cellars) 2016 White', 'Twin 2012 Red', 'Twin 2013 White',
+                  'Twin 2014 Rosé', 'No Vintage Red'],
+        'country': ['US', None, 'Chile', None, 'US', 'France', None, None]})
+
+    utils.fill_countries(df, utils.build_country_index(df['title'], df['country']))
+    assert list(df['country'].fillna('-')) == [
+        'US', 'US', 'Chile', 'Chile', 'US', 'France', '-', '-']
+
+    df = pd.DataFrame({'title': ['Twin 2014 Rosé'], 'country': [None]}, dtype='string')
+    utils.fill_countries(df, {'twin': {'US', 'France'}})
+    assert df['country'].isnull().all()
+
+
+def test_store_round_trip(tmp_path):
+    '''
+    The binary store reloads the data and the index without refitting
+    '''
+    selector = ws.WineSelector(n_similar=3)
+    selector.preprocess_data(make_reviews(tmp_path))
+    store = os.path.join(tmp_path, 'reviews.store')
+    selector.save_preprocessed_data(store)
+
+    loaded = ws.WineSelector(n_similar=3)
+    loaded.load_preprocessed_data(store)
+
+    pd.testing.assert_frame_equal(loaded.get_data(), selector.get_data(),
+                                  check_dtype=False)
+    for request, type_filter in [('pear and vanilla', None), ('plum', ['red'])]:
+        pd.testing.assert_frame_equal(
+            loaded.select_wine(request, type_filter=type_filter),
+            selector.select_wine(request, type_filter=type_filter),
+            check_dtype=False)
+
+    # A store is replaced, any other directory or file is kept
+    selector.save_preprocessed_data(store)
+    for path in (tmp_path / 'results', tmp_path / 'results.txt'):
+        if path.suffix:
+            path.write_text('important')
+        else:
+            path.mkdir()
+            (path / 'important.txt').write_text('important')
+        with pytest.raises(ValueError, match='not a wine selector store'):
+            selector.save_preprocessed_data(str(path))
+    assert (tmp_path / 'results' / 'important.txt').read_text() == 'important'
+    assert (tmp_path / 'results.txt').read_text() == 'important'
+
+
+def test_parallel_preprocessing_matches_single_process(tmp_path):
+    '''
+    Streaming the raw file through a process pool gives the same data
+    as preprocessing it in one chunk
+    '''
+    src = make_reviews(tmp_path)
+    single = ws.WineSelector()
+    single.preprocess_data(src, n_jobs=1)
+    parallel = ws.WineSelector()
+    parallel.preprocess_data(src, rows_per_chunk=3, n_jobs=2)
+
+    df = parallel.get_data()
+    pd.testing.assert_frame_equal(df, single.get_data())
+    assert df.loc[3, 'country'] == 'US'
+    assert df.loc[3, 'type'] == 'rose'
+    assert df.loc[0, 'compound_description'] == (
+        'Aromas of pear, apple and a hint of vanilla. White Blend Sicily '
+        'Nicosia 2013 Vigna (Etna)')
+
+
+def test_add_reviews_matches_full_rebuild(tmp_path):
+    '''
+    Adding reviews incrementally and reweighting gives the same index
+    as preprocessing all the reviews at once
+    '''
+    src = make_reviews(tmp_path)
+    selector = ws.WineSelector(n_similar=4)
+    selector.preprocess_data(src, n_jobs=1)
+
+    raw = pd.read_csv(src, index_col=0)
+    new_reviews = raw.iloc[[1, 5, 7]].set_axis([100, 101, 102])
+    new_reviews['province'] = raw['province'].iloc[[4, 0, 1]].to_numpy()
+    new_reviews['price'] += 1
+    assert selector.add_reviews(new_reviews) == 3
+    with pytest.raises(ValueError):
+        selector.add_reviews(new_reviews)
+
+    pd.concat([raw, new_reviews]).to_csv(src)
+    full = ws.WineSelector(n_similar=4)
+    full.preprocess_data(src, n_jobs=1)
+
+    requests = ['blackberry plum vanilla', 'cherry spice', 'pear']
+    drift = selector.measure_drift(requests)
+    assert drift['stale_rows'] == 7
+    assert drift['new_terms'] == 0
+
+    selector.reweight_index()
+    assert selector.measure_drift(requests) == {
+        'recall': 1.0, 'stale_rows': 0, 'new_terms': 0}
+    for request in requests:
+        expected = full.select_wine(request)
+        result = selector.select_wine(request)
+        assert list(result.index) == list(expected.index)
+        assert list(result['score']) == pytest.approx(list(expected['score']))
+
+
+def test_load_after_add_reviews(tmp_path):
+    '''
+    Loading other data forgets the incremental state of the reviews added before
+    '''
+    src = make_reviews(tmp_path)
+    raw = pd.read_csv(src, index_col=0)
+    larger = ws.WineSelector(n_similar=3, verbose=False)
+    larger.preprocess_data(src, n_jobs=1)
+    larger.add_reviews(raw.iloc[[1, 5]].set_axis([100, 101]).assign(price=99.0))
+    store = os.path.join(tmp_path, 'larger.store')
+    larger.save_preprocessed_data(store)
+    csv = os.path.join(tmp_path, 'larger.csv')
+    larger.save_preprocessed_data(csv)
+
+    for fileName in (store, csv):
+        selector = ws.WineSelector(n_similar=3, verbose=False)
+        selector.preprocess_data(src, n_jobs=1)
+        selector.add_reviews(raw.iloc[[7]].set_axis([200]).assign(price=50.0))
+        selector.load_preprocessed_data(fileName)
+        assert selector.measure_drift(['plum vanilla'])['stale_rows'] == 0
+        saved = os.path.join(tmp_path, 'saved.store')
+        selector.save_preprocessed_data(saved)
+        reference = ws.WineSelector(n_similar=3, verbose=False)
+        reference.load_preprocessed_data(fileName)
+        loaded = ws.WineSelector(n_similar=3, verbose=False)
+        loaded.load_preprocessed_data(saved)
+        for request in ['plum vanilla', 'cherry']:
+            expected = reference.select_wine(request)
+            result = loaded.select_wine(request)
+            assert list(result.index) == list(expected.index)
+            assert list(result['score']) == pytest.approx(list(expected['score']))
+
+
+def test_query_cache(tmp_path):
+    '''
+    Repeated and near-identical queries are served from the cache,
+    which is cleared when the data changes
+    '''
+    selector = ws.WineSelector(n_similar=3, cache_size=2)
+    selector.preprocess_data(make_reviews(tmp_path), n_jobs=1)
+
+    first = selector.select_wine('Pear and vanilla', price_filter=[10, 50])
+    first['score'] = 0
+    second = selector.select_wine('vanilla, the PEAR', price_filter=[10.0, 50.0])
+    assert selector.cache_info()['hits'] == 1
+    assert (second['score'] > 0).any()
+
+    selector.select_wine('plum')
+    selector.select_wine('cherry')
+    selector.select_wine('pear vanilla', price_filter=[10, 50])
+    assert selector.cache_info() == {'hits': 1, 'misses': 4, 'size': 2,
+                                     'max_size': 2, 'ttl': 3600}
+
+    new_reviews = pd.read_csv(make_reviews(tmp_path), index_col=0).iloc[:1].set_axis([100])
+    new_reviews['price'] += 1
+    selector.add_reviews(new_reviews)
+    assert selector.cache_info()['size'] == 0
+
+
+def test_ann_search_mode(tmp_path):
+    '''
+    Probing all the lists of the approximate index re-ranks every row,
+    so it finds the same wines as the exact search
+    '''
+    exact = ws.WineSelector(n_similar=3)
+    exact.preprocess_data(make_reviews(tmp_path), n_jobs=1)
+    ann = ws.WineSelector(n_similar=3, search_mode='ann')
+    ann.preprocess_data(make_reviews(tmp_path), n_jobs=1)
+    ann.build_ann_index(n_components=4, n_lists=2, n_probe=2)
+
+    for request, type_filter in [('pear vanilla', None), ('plum oak', ['red'])]:
+        pd.testing.assert_frame_equal(
+            ann.select_wine(request, type_filter=type_filter),
+            exact.select_wine(request, type_filter=type_filter))
+    assert ann.ann_recall_report(['pear', 'cherry spice'])['recall'] == 1.0
+    with pytest.raises(ValueError):
+        ann.set_search_mode('fuzzy')
+
+    # The default settings keep the recall of the approximate search
+    src = os.path.join(tmp_path, 'corpus.csv')
+    generate_corpus(3000, src)
+    ann = ws.WineSelector(search_mode='ann', verbose=False)
+    ann.preprocess_data(src, n_jobs=1)
+    rng = random.Random(1)
+    requests = [' '.join(rng.choices(WORDS, k=rng.randint(2, 6))) for _ in range(40)]
+    assert ann.ann_recall_report(requests)['recall'] >= 0.85
+
+
+def test_metrics_hooks(tmp_path, capsys):
+    '''
+    The stages and the query phases are reported as spans and counters,
+    a quiet selector prints nothing
+    '''
+    metrics = RecordingMetrics()
+    selector = ws.WineSelector(n_similar=2, metrics=metrics, verbose=False)
+    selector.preprocess_data(make_reviews(tmp_path), rows_per_chunk=3, n_jobs=1)
+    selector.select_wine('pear vanilla', type_filter=['white'])
+    selector.select_wine('pear vanilla', type_filter=['white'])
+
+    spans = metrics.get_spans()
+    for name in ['preprocess.country_index', 'preprocess.country_fill',
+                 'preprocess.assign_wine_types', 'index.fit', 'query.filter',
+                 'query.vectorize', 'query.score', 'query.top_k', 'query.merge']:
+        assert name in spans
+    assert len(spans['preprocess.country_fill']) == 3
+    assert len(spans['query.total']) == 2
+    assert metrics.get_counters() == {
+        'preprocess.rows': 8, 'preprocess.duplicates': 1,
+        'query.cache_misses': 1, 'query.cache_hits': 1,
+        'query.rows_scored': 2}
+    assert capsys.readouterr().out == ''
+
+
+def test_compact_mode(tmp_path):
+    '''
+    The memory-optimized mode keeps fewer and smaller columns
+    and selects the same wines
+    '''
+    src = make_reviews(tmp_path)
+    full = ws.WineSelector(n_similar=3)
+    full.preprocess_data(src, n_jobs=1)
+    compact = ws.WineSelector(n_similar=3, compact=True)
+    compact.preprocess_data(src, n_jobs=1)
+
+    df = compact.get_data()
+    assert 'compound_description' not in df
+    assert isinstance(df['type'].dtype, pd.CategoricalDtype)
+    assert compact.memory_report()['total'] < full.memory_report()['total']
+
+    store = os.path.join(tmp_path, 'reviews.store')
+    full.save_preprocessed_data(store)
+    loaded = ws.WineSelector(n_similar=3, compact=True)
+    loaded.load_preprocessed_data(store)
+    assert loaded.memory_report()['doc_matrix_mapped']
+
+    for selector in (compact, loaded):
+        for request, type_filter in [('pear vanilla', None), ('plum', ['red'])]:
+            expected = full.select_wine(request, type_filter=type_filter)
+            result = selector.select_wine(request, type_filter=type_filter)
+            assert list(result.index) == list(expected.index)
+            assert list(result['score']) == pytest.approx(list(expected['score']), rel=1e-5)
+
+    # New categories extend the categorical columns
+    new_reviews = pd.read_csv(src, index_col=0).iloc[[7]].set_axis([100])
+    new_reviews['variety'] = 'Grenache Blanc'
+    new_reviews['price'] += 1
+    loaded.add_reviews(new_reviews)
+    assert loaded.get_data().loc[100, 'variety'] == 'Grenache Blanc'
+    assert isinstance(loaded.get_data()['variety'].dtype, pd.CategoricalDtype)
+
+    # The price filters select the same wines at the price boundaries
+    new_reviews = new_reviews.set_axis([101]).assign(price=15.99, description='Dark plum.')
+    for selector in (full, loaded):
+        selector.add_reviews(new_reviews)
+        result = selector.select_wine('plum', price_filter=[15.99, 20])
+        assert 101 in result.index
+        assert result.loc[101, 'price'] == 15.99
+
+
+def test_query_service(tmp_path, monkeypatch):
+    '''
+    Concurrent queries are batched and coalesced and get the answers of select_wine,
+    also through HTTP
+    '''
+    selector = ws.WineSelector(n_similar=3, cache_size=0, verbose=False)
+    selector.preprocess_data(make_reviews(tmp_path), n_jobs=1)
+    queries = [('pear vanilla', None, None), ('plum', ['red'], None),
+               ('Pear  vanilla', None, None), ('toast', None, [10, 40])]
+
+    async def run(service, queries):
+        await service.start()
+        try:
+            return await asyncio.gather(*[service.select_wine(*query) for query in queries],
+                                        return_exceptions=True)
+        finally:
+            await service.stop()
+
+    metrics = RecordingMetrics()
+    service = WineSelectorService(selector, max_wait=0.05, metrics=metrics)
+    answers = asyncio.run(run(service, queries))
+    for query, answer in zip(queries, answers):
+        expected = selector.select_wine(*query)
+        assert [wine['index'] for wine in answer] == list(expected.index)
+        assert [wine['score'] for wine in answer] == pytest.approx(list(expected['score']))
+    counters = metrics.get_counters()
+    assert counters['service.batches'] == 1
+    assert counters['service.queries'] == 3
+    assert counters['service.coalesced'] == 1
+
+    # Invalid queries fail alone, before and in the batches
+    invalid = [('pear vanilla', None, None), ('plum', None, [10]), ('toast', 'red', None),
+               ('plum', [1], None), ('toast', None, [True, 20])]
+    answers = asyncio.run(run(WineSelectorService(selector, max_wait=0.05), invalid))
+    assert [wine['index'] for wine in answers[0]] == \
+        list(selector.select_wine('pear vanilla').index)
+    assert all(isinstance(answer, ValueError) for answer in answers[1:])
+    results = _select_batch([('pear', None, None), ('plum', None, (10.0,))], selector)
+    assert [wine['index'] for wine in results[0]] == list(selector.select_wine('pear').index)
+    assert isinstance(results[1], IndexError)
+
+    # Backpressure: the queries over max_pending are rejected
+    service = WineSelectorService(selector, max_wait=0.05, max_pending=2)
+    answers = asyncio.run(run(service, queries))
+    assert [isinstance(answer, ServiceOverloaded) for answer in answers] == \
+        [False, False, False, True]
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    loop = asyncio.new_event_loop()
+    server = loop.create_task(WineSelectorService(selector).serve(port=port))
+    thread = threading.Thread(target=loop.run_until_complete,
+                              args=(asyncio.wait([server]),))
+    thread.start()
+    try:
+        client = WineSelectorClient(f'http://127.0.0.1:{port}')
+        for _ in range(100):
+            try:
+                client.health()
+                break
+            except OSError:
+                time.sleep(0.05)
+        result = client.select_wine('plum', type_filter=['red'])
+        expected = selector.select_wine('plum', type_filter=['red'])
+        assert list(result.index) == list(expected.index)
+        assert list(result['title']) == list(expected['title'])
+        with pytest.raises(RuntimeError, match='400'):
+            client.select_wine(None)
+        with pytest.raises(RuntimeError, match='400'):
+            client.select_wine('plum', type_filter='red')
+
+        # Huge bodies are rejected and slow requests time out
+        monkeypatch.setattr(wine_selector_service, 'READ_TIMEOUT', 0.2)
+        for head in [b'POST /select HTTP/1.1\r\nContent-Length: 1000000000\r\n\r\n',
+                     b'POST /select HTTP/1.1\r\nContent-Length: 100\r\n\r\n{']:
+            with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+                sock.sendall(head)
+                answer = sock.makefile('rb').readline()
+            assert answer.split()[1] == (b'413' if b'1000000000' in head else b'408')
+    finally:
+        loop.call_soon_threadsafe(server.cancel)
+        thread.join()
+        loop.close()
+
+    # The client is imported without the selector stack
+    script = ('import sys, wine_selector_service; '
+              'print(sorted({"pandas", "scipy", "wine_selector"} & set(sys.modules)))')
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(ws.__file__)))
+    assert output.stdout.strip() == '[]'
+
+
+def test_deduplication(tmp_path):
+    '''
+    Duplicated reviews are dropped by preprocessing and by the ingestion,
+    the fingerprints are kept in the store
+    '''
+    src = make_reviews(tmp_path)
+    metrics = RecordingMetrics()
+    selector = ws.WineSelector(metrics=metrics, verbose=False)
+    selector.preprocess_data(src, n_jobs=1)
+    assert list(selector.get_data().index) == [0, 1, 2, 3, 4, 5, 7]
+    assert metrics.get_counters()['preprocess.duplicates'] == 1
+
+    csv = os.path.join(tmp_path, 'reviews-preprocessed.csv')
+    data = selector.get_data()
+    pd.concat([data, data.iloc[[5]].set_axis([6])]).to_csv(csv)
+    from_csv = ws.WineSelector(verbose=False)
+    from_csv.load_preprocessed_data(csv)
+    assert len(from_csv.get_data()) == 7
+
+    store = os.path.join(tmp_path, 'reviews.store')
+    selector.save_preprocessed_data(store)
+    metrics = RecordingMetrics()
+    loaded = ws.WineSelector(metrics=metrics, verbose=False, compact=True)
+    loaded.load_preprocessed_data(store)
+    assert 'preprocess.dedup' not in metrics.get_spans()
+
+    raw = pd.read_csv(src, index_col=0)
+    new_reviews = pd.concat([raw.iloc[[0, 5]], raw.iloc[[2, 2]]]).set_axis([100, 101, 102, 103])
+    new_reviews.loc[[102, 103], 'points'] = 95
+    assert loaded.add_reviews(new_reviews) == 1
+    assert loaded.add_reviews(new_reviews.set_axis([200, 201, 202, 203])) == 0
+    assert metrics.get_counters()['ingest.duplicates'] == 7
+    assert list(loaded.get_data().index) == [0, 1, 2, 3, 4, 5, 7, 102]
+
+
+def test_sharded_scoring(tmp_path):
+    '''
+    Scoring the shards in the worker pool with the filters pushed down
+    selects the same wines, also after the index changes
+    '''
+    src = make_reviews(tmp_path)
+    exact = ws.WineSelector(n_similar=3, cache_size=0, verbose=False)
+    exact.preprocess_data(src, n_jobs=1)
+    store = os.path.join(tmp_path, 'reviews.store')
+    exact.save_preprocessed_data(store)
+    sharded = ws.WineSelector(n_similar=3, cache_size=0, verbose=False,
+                              score_workers=2, shard_min_rows=0)
+    sharded.load_preprocessed_data(store)
+
+    new_reviews = pd.read_csv(src, index_col=0).iloc[[1]].set_axis([100])
+    new_reviews['price'] += 1
+    queries = [('pear vanilla', None, None), ('plum cherry', ['red'], [20, 80]),
+               ('toast', ['sparkling', 'rose'], None), ('cherry', ['orange'], None)]
+    try:
+        for step in range(2):
+            if step:
+                exact.add_reviews(new_reviews, reweight=True)
+                sharded.add_reviews(new_reviews, reweight=True)
+            for request, type_filter, price_filter in queries:
+                expected = exact.select_wine(request, type_filter, price_filter)
+                result = sharded.select_wine(request, type_filter, price_filter)
+                assert list(result.index) == list(expected.index)
+                assert list(result['score']) == pytest.approx(list(expected['score']))
+    finally:
+        sharded.close()
+
+    # The workers unpickle the scoring function without the selector
+    script = 'import sys, wine_selector_shards; print("wine_selector" in sys.modules)'
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(ws.__file__)))
+    assert output.stdout.strip() == 'False'
+
+
+def test_query_runtime(tmp_path):
+    '''
+    The query runtime answers like the selector from the store
+    without importing pandas, SciPy or scikit-learn
+    '''
+    selector = ws.WineSelector(n_similar=3, verbose=False)
+    selector.preprocess_data(make_reviews(tmp_path), n_jobs=1)
+    store = os.path.join(tmp_path, 'reviews.store')
+    selector.save_preprocessed_data(store)
+    runtime = WineSelectorRuntime(store, n_similar=3)
+
+    for request, type_filter, price_filter in [
+            ('Pear, the pear and VANILLA!', None, None), ('plum cherry', ['red'], [20, 80]),
+            ('toast brioche', ['sparkling', 'rose'], None), ('wine', None, None),
+            ('cherry', ['orange'], None)]:
+        expected = selector.select_wine(request, type_filter, price_filter)
+        result = runtime.select_wine(request, type_filter, price_filter)
+        assert [wine['index'] for wine in result] == list(expected.index)
+        assert [wine['score'] for wine in result] == pytest.approx(list(expected['score']))
+        assert [wine['title'] for wine in result] == list(expected['title'])
+        assert [wine['type'] for wine in result] == list(expected['type'])
+
+    # The results are cached by the request tokens and the filters
+    result = runtime.select_wine('vanilla and PEAR pear', None, None)
+    result[0]['score'] = 0
+    assert runtime.cache_info()['hits'] == 1
+    assert runtime.select_wine('pear, vanilla; pear') == \
+        runtime.select_wine('Pear, the pear and VANILLA!')
+    assert runtime.cache_info()['hits'] == 3
+
+    script = (f'import sys, wine_selector_runtime as r; '
+              f'r.WineSelectorRuntime({store!r}).select_wine("pear"); '
+              f'print(sorted({{"pandas", "scipy", "sklearn"}} & set(sys.modules)))')
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(ws.__file__)))
+    assert output.stdout.strip() == '[]'
+
+
+def test_rebuild_index_from_tokens(tmp_path):
+    '''
+    The index rebuilt from the kept tokens with other stop words and
+    weighting matches a vectorizer fitted on the text
+    '''
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    src = make_reviews(tmp_path)
+    selector = ws.WineSelector(n_similar=3, verbose=False)
+    selector.preprocess_data(src, n_jobs=1)
+    texts = selector.get_data()['compound_description']
+    store = os.path.join(tmp_path, 'reviews.store')
+    selector.save_preprocessed_data(store)
+
+    # The compact selector has no text left to tokenize
+    metrics = RecordingMetrics()
+    loaded = ws.WineSelector(n_similar=3, verbose=False, compact=True, metrics=metrics)
+    loaded.load_preprocessed_data(store)
+    stop_words = ['and', 'the', 'with', 'of', 'pear']
+    loaded.rebuild_index(stop_words=stop_words, sublinear_tf=True)
+    assert 'index.tokenize' not in metrics.get_spans()
+
+    tfidf = TfidfVectorizer(stop_words=stop_words, sublinear_tf=True)
+    matrix = tfidf.fit_transform(texts)
+    for request in ['pear vanilla vanilla', 'plum and cherry', 'toast']:
+        scores = (matrix @ tfidf.transform([request]).T).toarray()[:, 0]
+        best = sorted(range(len(scores)), key=lambda row: (-scores[row], row))[:3]
+        result = loaded.select_wine(request)
+        assert list(result.index) == list(texts.index[best])
+        assert list(result['score']) == pytest.approx(list(scores[best]))
+
+    # Rebuilding after an ingestion forgets the IDF history of the old vocabulary
+    new_reviews = pd.read_csv(src, index_col=0).iloc[[1]].set_axis([100])
+    new_reviews['description'] = 'Smoky espresso, leather and graphite.'
+    loaded.add_reviews(new_reviews)
+    loaded.rebuild_index()
+    assert loaded.measure_drift(['espresso leather'])['stale_rows'] == 0
+
+    # The ingestion weights the new rows with the IDF of the options
+    selector.rebuild_index(sublinear_tf=True, smooth_idf=False)
+    new_reviews = pd.read_csv(src, index_col=0).iloc[[1, 5, 7]].set_axis([100, 101, 102])
+    new_reviews['description'] = ['Plum and cherry.', 'Vanilla, vanilla and oak.', 'Spice.']
+    selector.add_reviews(new_reviews, reweight=True)
+    incremental = [selector.select_wine(request) for request in ['plum vanilla', 'cherry']]
+    selector.rebuild_index()
+    for result, request in zip(incremental, ['plum vanilla', 'cherry']):
+        expected = selector.select_wine(request)
+        assert list(result.index) == list(expected.index)
+        assert list(result['score']) == pytest.approx(list(expected['score']))
+
+    # The stop words and the weighting are saved for the runtime
+    loaded.save_preprocessed_data(store)
+    runtime = WineSelectorRuntime(store, n_similar=3)
+    expected = loaded.select_wine('plum plum cherry')
+    assert [wine['index'] for wine in runtime.select_wine('plum plum cherry')] == \
+        list(expected.index)
+
+
 if __name__ == '__main__':
     main()
@@ -1,65 +1,186 @@
 '''
 WineSelector is the class that provides functionality to select the wine by its description
 '''
-import re
+import heapq
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
+import numpy as np
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import linear_kernel
+from scipy.sparse import csr_matrix, vstack
+from wine_selector_ann import WineSelectorAnn
+from wine_selector_cache import WineSelectorCache
+from wine_selector_metrics import WineSelectorMetrics
+from wine_selector_runtime import TEXT_COLUMNS, encode_texts, top_k
+from wine_selector_shards import WineSelectorShards
+from wine_selector_store import WineSelectorStore, get_memmap
+from wine_selector_tokens import WineSelectorTokens, get_idf, tokenize
 from wine_selector_utils import WineSelectorUtils
 
 
+_worker_utils = None
+_worker_country_index = None
+
+
+def _init_preprocess_worker(country_index: dict):
+    '''
+    Keep the country index and the utilities in the preprocessing worker
+    '''
+    global _worker_utils, _worker_country_index
+    _worker_utils = WineSelectorUtils()
+    _worker_country_index = country_index
+
+
+def _preprocess_rows(chunk: pd.DataFrame, utils: WineSelectorUtils,
+                     country_index: dict) -> tuple[pd.DataFrame, tuple, dict]:
+    '''
+    Run the per-row preprocessing stages on a chunk of the raw data.
+    Returns the chunk, the tokens of its compound descriptions
+    and the duration of every stage
+    '''
+    timings = {}
+
+    start = time.perf_counter()
+    utils.fill_countries(chunk, country_index)
+    timings['country_fill'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    chunk.dropna(subset=["country", 'variety'], inplace=True)
+    timings['dropna'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    chunk['compound_description'] = utils.get_compound_description(chunk)
+    timings['compound_description'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tokens = tokenize(chunk['compound_description'].tolist())
+    timings['tokenize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    utils.assign_wine_types(chunk)
+    timings['assign_wine_types'] = time.perf_counter() - start
+
+    return chunk, tokens, timings
+
+
+def _preprocess_chunk(chunk: pd.DataFrame) -> tuple[pd.DataFrame, tuple, dict]:
+    '''
+    Run the per-row preprocessing stages in the preprocessing worker
+    '''
+    return _preprocess_rows(chunk, _worker_utils, _worker_country_index)
+
+
+# Columns kept by the memory-optimized mode: the columns of the results and
+# the ones needed to rebuild the compound description and to fill countries
+COMPACT_COLUMNS = ['title', 'description', 'type', 'price', 'points', 'variety',
+                   'country', 'province']
+CATEGORY_COLUMNS = ['type', 'variety', 'country', 'province']
+
+
+def _nbytes(*arrays) -> int:
+    return sum(array.nbytes for array in arrays if array is not None)
+
+
 class WineSelector:
     '''
     WineSelector is the class that provides functionality to select the wine by its description
     '''
 
-    def __init__(self, chunk_size: int = 10000, n_similar: int = 5):
+    def __init__(self, chunk_size: int = 10000, n_similar: int = 5,
+                 cache_size: int = 1024, cache_ttl: float | None = 3600,
+                 search_mode: str = 'exact',
+                 metrics: WineSelectorMetrics | None = None, verbose: bool = True,
+                 compact: bool = False, score_workers: int = 1,
+                 shard_min_rows: int = 100000):
         self.__chunk_size = chunk_size
         self.__n_similar = n_similar
+
+        # Memory-optimized mode: only COMPACT_COLUMNS are kept, low-cardinality
+        # columns are categorical, the points are downcast, the compound
+        # description is dropped once indexed and the index weights are float32
+        self.__compact = compact
+
+        # Timed spans and counters go to the metrics hooks,
+        # the progress messages are printed only if verbose
+        self.__metrics = metrics or WineSelectorMetrics()
+        self.__verbose = verbose
+        self.__search_mode = None
         self.__data = None
         self.__utils = WineSelectorUtils()
 
-        # Create vectorizer with additional stop words
-        self.__stop_words = self.__utils.get_stop_words()
-        self.__tfidf = TfidfVectorizer(stop_words=list(self.__stop_words))
+        # Results of the recent queries, cleared whenever the index changes
+        self.__cache = WineSelectorCache(cache_size, cache_ttl)
+        self.__analyzer = None
 
-    def __country_fill(self):
-        """
-        The function takes first words in 'title' column before digits
-        representing the year for the rows with null values in 'country' column
-        and searches through the dataframe in other rows to get the country and
-        fills null values if any
-        """
+        # Corpus index: L2-normalized TF-IDF rows of 'compound_description'
+        # and the data index label of every row of the matrix
+        self.__doc_matrix = None
+        self.__doc_labels = None
 
-        pattern = r"^(.*?)(?=\b\d{4}\b)"  # find the first words before digits
-        # list of titles with null values as countries
-        titles = list(self.__data[self.__data.country.isnull()].title)
-        title_country_dict = (
-            {}
-        )  # a dictionary to keep track of matching titles and countries
-        for title in titles:
-            match = re.search(pattern, title)
-            countries = []  # a list of found countries
-            try:
-                matched_string = match.group()
-                mask = self.__data["title"].str.contains(
-                    matched_string, case=False, na=False)
-                # a list of unique country values
-                countries = list(
-                    set(self.__data[mask][self.__data[mask]["country"].notnull()].country))
-                if len(countries) == 1:
-                    title_country_dict[matched_string] = countries[0]
-            except AttributeError:
-                continue
+        # Filter indexes: sorted row ids of every wine type and the row ids
+        # sorted by price (rows without price are left out)
+        self.__type_rows = {}
+        self.__price_order = None
+        self.__price_sorted = None
+
+        # Dedup state: 64-bit fingerprint of every row over the dedup key
+        # columns and their set for the ingestion, both built lazily if missing
+        self.__fingerprints = None
+        self.__fingerprint_set = None
+
+        # Incremental ingestion state: title prefix to countries index,
+        # document frequencies of the terms, the IDF vectors the rows were
+        # weighted with and the position of this vector for every row
+        self.__country_index = None
+        self.__doc_freq = None
+        self.__idf_history = None
+        self.__row_epoch = None
+
+        # Approximate nearest neighbour index, built on the first 'ann' query
+        # if build_ann_index was not called
+        self.__ann = None
+        self.__ann_options = {}
+        self.set_search_mode(search_mode)
 
-        for key, value in title_country_dict.items():
-            mask = self.__data["title"].str.contains(key, case=False, na=False)
-            self.__data.loc[mask, "country"] = self.__data.loc[mask, "country"].fillna(
-                value
-            )  # replaces all nulls with the found country names
+        # Sharded scoring of the exact queries over score_workers processes,
+        # used for at least shard_min_rows rows and reloaded when the index changes
+        self.__score_workers = score_workers
+        self.__shard_min_rows = shard_min_rows
+        self.__shards = None
+        self.__shards_loaded = False
 
-    def __split_data_to_chunks(self, data: pd.DataFrame) -> list[pd.DataFrame]:
+        # Vectorizer with additional stop words, created on the first use so
+        # scikit-learn is imported only to preprocess or query. The stop words
+        # and the weighting options are changed by rebuild_index
+        self.__tfidf = None
+        self.__stop_words = None
+        self.__tfidf_options = {'sublinear_tf': False, 'smooth_idf': True}
+
+        # Token ids of the compound descriptions, the index is built from them
+        self.__tokens = None
+
+    def __get_tfidf(self):
+        '''
+        Get the vectorizer, creating it on the first call
+        '''
+        if self.__tfidf is None:
+            from sklearn.feature_extraction.text import TfidfVectorizer
+            self.__tfidf = TfidfVectorizer(stop_words=list(self.__get_stop_words()),
+                                           **self.__tfidf_options)
+        return self.__tfidf
+
+    def __get_stop_words(self) -> frozenset:
+        '''
+        Get the stop words of the index
+        '''
+        if self.__stop_words is None:
+            self.__stop_words = frozenset(self.__utils.get_stop_words())
+        return self.__stop_words
+
+    def __split_data_to_chunks(self, data: pd.DataFrame | np.ndarray) -> list:
         """
         The method splits the data into chunks of the size defined by the chunk_size attribute
         """
@@ -79,112 +200,908 @@ class WineSelector:
 
         return chunks
 
+    def __progress(self, message: str, end: str = '\n'):
+        '''
+        Print the progress message if the selector is verbose
+        '''
+        if self.__verbose:
+            print(message, end=end)
+
     def get_data(self):
         '''
         Get the data
         '''
         return self.__data
 
-    def preprocess_data(self, fileName: str):
+    def __build_country_index(self, fileName: str, rows_per_chunk: int) -> dict:
+        '''
+        First pass over the raw data: index the title prefixes to the countries,
+        reading only the 'title' and 'country' columns
+        '''
+        country_index = {}
+        for chunk in pd.read_csv(fileName, usecols=['title', 'country'],
+                                 chunksize=rows_per_chunk):
+            chunk_index = self.__utils.build_country_index(
+                chunk['title'], chunk['country'])
+            for prefix, countries in chunk_index.items():
+                country_index.setdefault(prefix, set()).update(countries)
+        return country_index
+
+    def preprocess_data(self, fileName: str, rows_per_chunk: int = 50000,
+                        n_jobs: int | None = None):
         '''
-        Initialize the data
+        Initialize the data.
+
+        The raw file is streamed in chunks of rows_per_chunk rows. The country
+        index is built in a first pass, then the per-row stages run on the
+        chunks in a pool of n_jobs processes (all the cores by default, 1 runs
+        in this process) with at most two chunks per process in flight
         '''
         if self.__data is None:
-            print("Loading data...")
-            self.__data = pd.read_csv(fileName, index_col=0)
+            self.__progress("Apply correction to the DB...")
+            with self.__metrics.span('preprocess.country_index'):
+                country_index = self.__build_country_index(fileName, rows_per_chunk)
 
-            print("Apply correction to the DB...")
-            self.__country_fill()
+            self.__progress("Loading and preprocessing data...")
+            n_jobs = n_jobs or os.cpu_count() or 1
+            # Text columns are typed upfront, so chunks where a column is
+            # all empty do not change its dtype
+            columns = pd.read_csv(fileName, index_col=0, nrows=0).columns
+            reader = pd.read_csv(fileName, index_col=0, chunksize=rows_per_chunk,
+                                 dtype={col: str for col in columns
+                                        if col not in ('points', 'price')})
+            chunks = []
+            self.__tokens = WineSelectorTokens()
+            with self.__metrics.span('preprocess.rows'):
+                if n_jobs == 1:
+                    for chunk in reader:
+                        self.__add_chunk(chunks, *_preprocess_rows(
+                            chunk, self.__utils, country_index))
+                else:
+                    with ProcessPoolExecutor(n_jobs, initializer=_init_preprocess_worker,
+                                             initargs=(country_index,)) as executor:
+                        in_flight = deque()
+                        for chunk in reader:
+                            in_flight.append(executor.submit(_preprocess_chunk, chunk))
+                            if len(in_flight) >= 2 * n_jobs:
+                                self.__add_chunk(chunks, *in_flight.popleft().result())
+                        while in_flight:
+                            self.__add_chunk(chunks, *in_flight.popleft().result())
+            self.__progress('')
 
-            print("Dropping rows with null values in 'country' and 'variety' columns...")
-            self.__data.dropna(subset=["country", 'variety'], inplace=True)
+            with self.__metrics.span('preprocess.concat'):
+                self.__data = pd.concat(chunks)
+            self.__country_index = country_index
+            self.__deduplicate()
 
-            print("Creating a compound description...")
-            cols = ['description', 'variety', 'province', 'title']
-            self.__data['compound_description'] = self.__data.apply(
-                lambda row: ' '.join(str(row[col]) for col in cols), axis=1)
+            self.__progress("Building the search index...")
+            self.__build_index()
 
-            print("Assigning wine types...")
-            self.__utils.assign_wine_types(self.__data)
+        self.__progress("Data is loaded and preprocessed!")
 
-        print("Data is loaded and preprocessed!")
+    def __add_chunk(self, chunks: list, chunk: pd.DataFrame, tokens: tuple, timings: dict):
+        '''
+        Collect the preprocessed chunk and its tokens
+        and report the timings of its stages
+        '''
+        chunks.append(chunk)
+        self.__tokens.append(*tokens)
+        for stage, seconds in timings.items():
+            self.__metrics.on_span(f'preprocess.{stage}', seconds)
+        self.__metrics.on_counter('preprocess.rows', len(chunk))
+        self.__progress(f'\rChunk {len(chunks)} done!', end='')
 
     def save_preprocessed_data(self, fileName: str):
         '''
-        Save the preprocessed data to the file
+        Save the preprocessed data to the file. A '.csv' file name keeps the
+        legacy CSV format, any other name is saved as a binary store
+        with the search index
         '''
         if self.__data is not None:
-            self.__data.to_csv(fileName, index=True,
-                               index_label='index', header=True)
+            if fileName.endswith('.csv'):
+                self.__data.to_csv(fileName, index=True,
+                                   index_label='index', header=True)
+                return
+
+            self.__ensure_index()
+            self.reweight_index()
+            with self.__metrics.span('store.save'):
+                WineSelectorStore(fileName).save(self.__data, {
+                    'vocabulary': np.array(self.__get_tfidf().get_feature_names_out(), dtype=str),
+                    'idf': self.__get_tfidf().idf_,
+                    'stop_words': np.array(sorted(self.__get_stop_words()), dtype=str),
+                    'data': self.__doc_matrix.data,
+                    'indices': self.__doc_matrix.indices,
+                    'indptr': self.__doc_matrix.indptr,
+                    'fingerprints': self.__get_fingerprints(),
+                    **self.__get_tokens().get_arrays(),
+                    **self.__runtime_arrays(),
+                }, {'shape': list(self.__doc_matrix.shape), 'tfidf': self.__tfidf_options})
+
+    def __runtime_arrays(self) -> dict:
+        '''
+        Result columns of the rows as plain arrays for WineSelectorRuntime:
+        the index labels, type codes and names, prices, points and the texts
+        as UTF-8 blobs with their offsets
+        '''
+        labels = self.__doc_labels.to_numpy()
+        type_codes, type_names = pd.factorize(self.__data['type'].astype(object))
+        arrays = {
+            'labels': labels.astype(np.int64) if np.issubdtype(labels.dtype, np.integer)
+            else labels.astype(str),
+            'type_codes': type_codes.astype(np.int16),
+            'type_names': np.array(type_names, dtype=str),
+            'price': self.__data['price'].to_numpy(dtype=np.float64),
+            'points': self.__data['points'].to_numpy(dtype=np.float64),
+        }
+        for column in TEXT_COLUMNS:
+            arrays[f'{column}_blob'], arrays[f'{column}_offsets'] = encode_texts(
+                self.__data[column].astype(object).tolist())
+        return arrays
 
     def load_preprocessed_data(self, fileName: str):
         '''
-        Load the preprocessed data from the file
+        Load the preprocessed data from the file, either a legacy CSV file
+        or a binary store, whose search index is memory-mapped and not refitted
+        '''
+        if fileName.endswith('.csv'):
+            self.__data = pd.read_csv(fileName, index_col=0)
+            self.__country_index = None
+            self.__tokens = None
+            self.__deduplicate()
+            self.__build_index()
+            return
+
+        with self.__metrics.span('store.load'):
+            store = WineSelectorStore(fileName)
+            if self.__compact:
+                # The unused columns are not even read
+                self.__data = self.__compact_frame(store.load_data(COMPACT_COLUMNS))
+            else:
+                self.__data = store.load_data()
+
+            if store.has_array('stop_words'):
+                self.__stop_words = frozenset(
+                    store.load_array('stop_words', mmap=False).tolist())
+            self.__tfidf_options.update(store.get_info().get('tfidf', {}))
+            self.__set_vectorizer(store.load_array('vocabulary', mmap=False).tolist(),
+                                  store.load_array('idf', mmap=False))
+            self.__doc_matrix = csr_matrix(
+                (store.load_array('data'), store.load_array('indices'),
+                 store.load_array('indptr')), shape=tuple(store.get_info()['shape']))
+            # The data of a store is deduplicated when it is saved, the
+            # fingerprints of older stores are computed on the first ingestion
+            self.__fingerprints = store.load_array('fingerprints', mmap=False) \
+                if store.has_array('fingerprints') else None
+            self.__fingerprint_set = None
+            # Older stores are tokenized again on the next rebuild
+            self.__tokens = WineSelectorTokens(
+                store.load_array('token_vocabulary', mmap=False).tolist(),
+                store.load_array('token_ids'), store.load_array('token_offsets')) \
+                if store.has_array('token_ids') else None
+        self.__doc_labels = self.__data.index.copy()
+        self.__reset_incremental_state()
+        self.__country_index = None
+        self.__ann = None
+        self.__build_filter_indexes()
+        self.__cache.clear()
+
+    def __deduplicate(self):
+        '''
+        Drop the rows with the same title, description, price and points as
+        an earlier row, keeping the fingerprints of the remaining rows
+        '''
+        with self.__metrics.span('preprocess.dedup'):
+            fingerprints = self.__utils.get_fingerprints(self.__data)
+            unique = ~pd.Index(fingerprints).duplicated()
+            self.__metrics.on_counter('preprocess.duplicates', int((~unique).sum()))
+            if not unique.all():
+                self.__data = self.__data[unique]
+                if self.__tokens is not None:
+                    self.__tokens.select(unique)
+            self.__fingerprints = fingerprints[unique]
+            self.__fingerprint_set = None
+
+    def __get_fingerprints(self) -> np.ndarray:
+        '''
+        Fingerprints of the rows of the data, computed if they were not
+        kept or the rows were changed
+        '''
+        if self.__fingerprints is None or len(self.__fingerprints) != len(self.__data):
+            self.__fingerprints = self.__utils.get_fingerprints(self.__data)
+            self.__fingerprint_set = None
+        return self.__fingerprints
+
+    def __get_tokens(self) -> WineSelectorTokens:
+        '''
+        Tokens of the compound descriptions of the data, tokenized
+        if they were not kept or the rows were changed
+        '''
+        if self.__tokens is None or len(self.__tokens) != len(self.__data):
+            if 'compound_description' in self.__data:
+                texts = self.__data['compound_description']
+            else:
+                texts = self.__utils.get_compound_description(self.__data)
+            with self.__metrics.span('index.tokenize'):
+                self.__tokens = WineSelectorTokens(*tokenize(texts.tolist()))
+        return self.__tokens
+
+    def __set_vectorizer(self, terms: list[str], idf: np.ndarray):
+        '''
+        Set the vocabulary and the IDF weights of a new vectorizer
+        with the current stop words and options
+        '''
+        self.__tfidf = None
+        self.__analyzer = None
+        self.__get_tfidf().vocabulary_ = {term: i for i, term in enumerate(terms)}
+        self.__get_tfidf().idf_ = idf
+
+    def __build_index(self):
+        '''
+        Compute the vocabulary and IDF weights once over the whole corpus from
+        its tokens, like TfidfVectorizer.fit_transform, and keep the
+        L2-normalized document matrix and the filter indexes for the queries
+        '''
+        tokens = self.__get_tokens()
+        with self.__metrics.span('index.fit'):
+            self.__doc_matrix, terms, idf = tokens.tfidf(
+                self.__get_stop_words(), **self.__tfidf_options)
+            self.__set_vectorizer(terms, idf)
+        self.__doc_labels = self.__data.index.copy()
+        # All the rows are weighted with the new IDF vector
+        self.__reset_incremental_state()
+        self.__ann = None
+
+        if self.__compact:
+            self.__data = self.__compact_frame(self.__data)
+            self.__doc_matrix = self.__doc_matrix.astype(np.float32)
+
+        with self.__metrics.span('index.filters'):
+            self.__build_filter_indexes()
+        self.__cache.clear()
+
+    def rebuild_index(self, stop_words=None, sublinear_tf: bool | None = None,
+                      smooth_idf: bool | None = None):
+        '''
+        Rebuild the index from the kept tokens with other stop words or
+        TfidfVectorizer weighting options, without processing the text again.
+        The options not given are kept
+        '''
+        if stop_words is not None:
+            self.__stop_words = frozenset(stop_words)
+        if sublinear_tf is not None:
+            self.__tfidf_options['sublinear_tf'] = sublinear_tf
+        if smooth_idf is not None:
+            self.__tfidf_options['smooth_idf'] = smooth_idf
+        self.__build_index()
+
+    def __compact_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Memory-optimized copy of the data: COMPACT_COLUMNS only, categorical
+        low-cardinality columns and downcast points. The prices stay float64,
+        so the price filters select the same rows as in the full mode. New
+        categories are added to the categories of the current data, so the
+        frames concatenate without losing the categorical dtype
+        '''
+        df = df[[column for column in COMPACT_COLUMNS if column in df]].copy()
+        for column in CATEGORY_COLUMNS:
+            if column not in df:
+                continue
+            if self.__data is not None and column in self.__data and \
+                    isinstance(self.__data[column].dtype, pd.CategoricalDtype):
+                current = self.__data[column].cat.categories
+                new = pd.Index(df[column].dropna().unique()).difference(current)
+                if len(new):
+                    self.__data[column] = self.__data[column].cat.add_categories(new)
+                df[column] = df[column].astype(self.__data[column].dtype)
+            else:
+                df[column] = df[column].astype('category')
+        df['price'] = df['price'].astype(np.float64)
+        df['points'] = pd.to_numeric(df['points'], downcast='integer')
+        return df
+
+    def __build_filter_indexes(self):
+        '''
+        Build the type and price indexes of the rows
+        '''
+        types = self.__data['type'].to_numpy()
+        self.__type_rows = {
+            wine_type: np.flatnonzero(types == wine_type)
+            for wine_type in pd.unique(types)}
+
+        price = self.__data['price'].to_numpy(dtype=float)
+        priced = np.flatnonzero(~np.isnan(price))
+        self.__price_order = priced[np.argsort(price[priced], kind='stable')]
+        self.__price_sorted = price[self.__price_order]
+        self.__shards_loaded = False
+
+    def __extend_filter_indexes(self, reviews: pd.DataFrame, start: int):
+        '''
+        Add the rows of the reviews appended at the row start to the type and
+        price indexes. The new rows are merged into the rows sorted by price
+        with a binary search, the existing rows are not sorted again
+        '''
+        rows = np.arange(start, start + len(reviews))
+        types = reviews['type'].to_numpy()
+        for wine_type in pd.unique(types):
+            self.__type_rows[wine_type] = np.concatenate([
+                self.__type_rows.get(wine_type, np.empty(0, dtype=np.intp)),
+                rows[types == wine_type]])
+
+        price = reviews['price'].to_numpy(dtype=float)
+        priced = np.flatnonzero(~np.isnan(price))
+        priced = priced[np.argsort(price[priced], kind='stable')]
+        # The existing rows of the same price come first, as in a stable sort
+        positions = np.searchsorted(self.__price_sorted, price[priced], side='right')
+        self.__price_order = np.insert(self.__price_order, positions, rows[priced])
+        self.__price_sorted = np.insert(self.__price_sorted, positions, price[priced])
+        self.__shards_loaded = False
+
+    def __ensure_index(self):
+        '''
+        Rebuild the index if the rows of the data were changed since it was built
+        '''
+        if self.__doc_labels is None or len(self.__doc_labels) != len(self.__data):
+            self.__build_index()
+
+    def __filter_rows(self, type_filter: list[str] | None,
+                      price_filter: list[float] | None) -> np.ndarray:
+        '''
+        Sorted ids of the index rows passing the type and price filters.
+        The filters are resolved with the precomputed indexes: a union of the
+        type row sets and a binary search in the rows sorted by price
+        '''
+        rows = None
+        if type_filter:
+            rows = np.unique(np.concatenate(
+                [self.__type_rows.get(wine_type, np.empty(0, dtype=np.intp))
+                 for wine_type in type_filter]))
+        if price_filter:
+            first = np.searchsorted(
+                self.__price_sorted, price_filter[0], side='left')
+            last = np.searchsorted(
+                self.__price_sorted, price_filter[1], side='right')
+            priced = np.sort(self.__price_order[first: last])
+            rows = priced if rows is None else np.intersect1d(
+                rows, priced, assume_unique=True)
+        if rows is None:
+            rows = np.arange(self.__doc_matrix.shape[0])
+        return rows
+
+    def __score_rows(self, rows: np.ndarray, request_matrix) -> np.ndarray:
+        '''
+        Dense scores of the given sorted index rows against the vectorized
+        requests (one column per request) with a sparse product, for the batches
         '''
-        self.__data = pd.read_csv(fileName, index_col=0)
+        if rows[-1] - rows[0] + 1 == len(rows):
+            block = self.__doc_matrix[rows[0]: rows[-1] + 1]
+        else:
+            block = self.__doc_matrix[rows]
+        return (block @ request_matrix).toarray()
 
-    def __choose_wine(self, data: pd.DataFrame, wine_request: str):
+    def __wines_frame(self, rows: list[int], scores: list[float],
+                      **columns) -> pd.DataFrame:
+        '''
+        Dataframe of the selected index rows with their scores and descriptions
+        '''
+        rows = np.array(rows, dtype=np.intp)
+        selected_wines = pd.DataFrame(
+            columns, index=pd.Index(self.__doc_labels[rows], name='index'))
+        selected_wines['score'] = scores
+        for column in ['title', 'description', 'type', 'price', 'points', 'variety']:
+            selected_wines[column] = self.__data[column].iloc[rows].to_numpy()
+        return selected_wines
+
+    def __score_request(self, rows: np.ndarray, request_vector) -> np.ndarray:
+        '''
+        Scores of the given sorted index rows against one vectorized request:
+        one sparse mat-vec of the rows by the dense request vector
+        '''
+        vector = request_vector.toarray().ravel()
+        if len(rows) == self.__doc_matrix.shape[0]:
+            return self.__doc_matrix @ vector
+        return self.__doc_matrix[rows] @ vector
+
+    def __choose_wine(self, rows: np.ndarray, request_vector):
         """
-        The function takes the dataset, the vectorizer, and a wine request as input
-        and returns the most similar wines to the request.
+        The function takes the index rows to search in and a vectorized wine
+        request as input and returns the most similar wines to the request.
 
-        Result is a dictionary with the index of the wine in the dataset as a key
-        and the similarity score as a value.
+        Result is a list of (row, score) pairs ordered from the best match.
         """
+        with self.__metrics.span('query.score'):
+            scores = self.__score_request(rows, request_vector)
+        with self.__metrics.span('query.top_k'):
+            best = top_k(scores, rows, self.__n_similar)
+        self.__metrics.on_counter('query.rows_scored', len(rows))
+        return list(zip(rows[best].tolist(), scores[best].tolist()))
 
-        selection = {}
+    def __choose_wine_sharded(self, request_vector, type_filter: list[str] | None,
+                              price_filter: list[float] | None):
+        '''
+        Score the request over the row shards of the index in the worker
+        pool, publishing the current index to the workers if it changed.
 
-        portions = self.__split_data_to_chunks(data)
-        for cnt, portion in enumerate(portions):
-            p = list(portion['compound_description'])
-            # Add the request to the portion - now its index is the last one!
-            p.append(wine_request)
+        Result is a list of (row, score) pairs ordered from the best match
+        '''
+        if self.__shards is None:
+            self.__shards = WineSelectorShards(self.__score_workers)
+        if not self.__shards_loaded:
+            with self.__metrics.span('index.shards'):
+                self.__shards.load(self.__doc_matrix, self.__data['type'],
+                                   self.__data['price'].to_numpy(dtype=float))
+            self.__shards_loaded = True
 
-            tfidf_matrix = self.__tfidf.fit_transform(p)
-            cosine_sim = linear_kernel(tfidf_matrix)
+        with self.__metrics.span('query.score'):
+            wine_choice, n_rows = self.__shards.search(
+                request_vector, type_filter, price_filter, self.__n_similar)
+        self.__metrics.on_counter('query.rows_scored', n_rows)
+        return wine_choice
 
-            # Choose the match for the last index of sim matrix
-            sim_scores = list(cosine_sim[-1])
-            sim_scores = sorted(enumerate(sim_scores),
-                                key=lambda x: x[1], reverse=True)
+    def close(self):
+        '''
+        Stop the scoring workers and free their shared memory
+        '''
+        if self.__shards is not None:
+            self.__shards.close()
+            self.__shards = None
+            self.__shards_loaded = False
 
-            # Get the top 5 most similar wines
-            sim_scores = sim_scores[1: self.__n_similar + 1]
+    def __choose_wine_ann(self, rows: np.ndarray, request_vector,
+                          n_probe: int | None = None):
+        """
+        The function takes the index rows to search in and a vectorized wine
+        request as input and returns the most similar wines among the
+        candidates of the approximate nearest neighbour index, re-ranked by
+        their exact scores. Falls back to the exact search if the filters
+        leave too few candidates.
 
-            for idx, score in sim_scores:
-                # Get index of the wine in initial dataset
-                wine_idx = portion.index[idx]
-                selection[wine_idx] = score
+        Result is a list of (row, score) pairs ordered from the best match.
+        """
+
+        if self.__ann is None:
+            self.build_ann_index(**self.__ann_options)
 
-            print(f'\rPortion {cnt+1} of {len(portions)} done!', end='')
+        with self.__metrics.span('query.ann_search'):
+            candidates = self.__ann.search(request_vector, n_probe=n_probe)
+            if len(rows) < self.__doc_matrix.shape[0]:
+                candidates = np.intersect1d(candidates, rows, assume_unique=True)
+        if len(candidates) < min(self.__n_similar, len(rows)):
+            self.__metrics.on_counter('query.ann_fallbacks', 1)
+            return self.__choose_wine(rows, request_vector)
+        if len(candidates) == 0:
+            return []
 
-        print('\nDone')
-        return selection
+        with self.__metrics.span('query.score'):
+            scores = self.__score_request(candidates, request_vector)
+        with self.__metrics.span('query.top_k'):
+            best = top_k(scores, candidates, self.__n_similar)
+        self.__metrics.on_counter('query.rows_scored', len(candidates))
+        return list(zip(candidates[best].tolist(), scores[best].tolist()))
 
     def select_wine(self, request: str,
                     type_filter: list[str] | None = None,
                     price_filter: list[float] | None = None):
         '''
-        Select the wine by the request
+        Select the wine by the request. The results are cached by the
+        normalized request and the filters
         '''
+        with self.__metrics.span('query.total'):
+            return self.__select_wine(request, type_filter, price_filter)
 
-        # Filter the data by type and price
-        data = self.__data
-        if type_filter:
-            data = data[data['type'].isin(type_filter)]
-        if price_filter:
-            data = data[(data['price'] >= price_filter[0]) &
-                        (data['price'] <= price_filter[1])]
+    def __select_wine(self, request: str, type_filter: list[str] | None,
+                      price_filter: list[float] | None):
+        '''
+        Select the wine by the request, timed by select_wine
+        '''
+        self.__ensure_index()
 
-        wine_choice = self.__choose_wine(data, request)
+        key = self.__cache_key(request, type_filter, price_filter)
+        selected_wines = self.__cache.get(key)
+        if selected_wines is not None:
+            self.__metrics.on_counter('query.cache_hits', 1)
+            return selected_wines.copy()
+        self.__metrics.on_counter('query.cache_misses', 1)
+
+        # Only the request is vectorized, the rows are scored with a mat-vec
+        with self.__metrics.span('query.vectorize'):
+            request_vector = self.__get_tfidf().transform([request])
+
+        if self.__search_mode == 'exact' and self.__score_workers > 1 and \
+                self.__doc_matrix.shape[0] >= self.__shard_min_rows:
+            # The filters are applied by the shard workers
+            wine_choice = self.__choose_wine_sharded(request_vector, type_filter, price_filter)
+        else:
+            # Resolve the type and price filters to the index rows
+            with self.__metrics.span('query.filter'):
+                rows = self.__filter_rows(type_filter, price_filter)
+            if self.__search_mode == 'ann':
+                wine_choice = self.__choose_wine_ann(rows, request_vector)
+            else:
+                wine_choice = self.__choose_wine(rows, request_vector)
 
         # Create a dataframe with the selected wines and their scores
-        selected_wines = pd.DataFrame(
-            list(wine_choice.items()), columns=['index', 'score'])
-        selected_wines['index'] = selected_wines['index'].astype(int)
-        selected_wines.set_index('index', inplace=True)
-        selected_wines = selected_wines.merge(
-            data[['title', 'description', 'type', 'price', 'points', 'variety']], left_index=True, right_index=True)
-        selected_wines.sort_values('score', ascending=False, inplace=True)
+        with self.__metrics.span('query.merge'):
+            selected_wines = self.__wines_frame([row for row, _ in wine_choice],
+                                                [score for _, score in wine_choice])
+        self.__cache.put(key, selected_wines)
+        return selected_wines.copy()
 
-        return selected_wines
+    def __cache_key(self, request: str, type_filter: list[str] | None,
+                    price_filter: list[float] | None) -> tuple:
+        '''
+        Cache key of the query: the request tokens without the stop words
+        (their order does not change the scores), the filters and n_similar
+        '''
+        if self.__analyzer is None:
+            self.__analyzer = self.__get_tfidf().build_analyzer()
+        return (tuple(sorted(self.__analyzer(request))),
+                tuple(sorted(type_filter)) if type_filter else None,
+                tuple(float(price) for price in price_filter) if price_filter else None,
+                self.__n_similar)
+
+    def set_search_mode(self, search_mode: str):
+        '''
+        Set the search mode of select_wine: 'exact' scores all the filtered
+        rows, 'ann' re-ranks the candidates of the approximate index
+        '''
+        if search_mode not in ('exact', 'ann'):
+            raise ValueError(f"Unknown search mode: {search_mode}")
+        self.__search_mode = search_mode
+        self.__cache.clear()
+
+    def build_ann_index(self, **options):
+        '''
+        Build the approximate nearest neighbour index over the document matrix.
+        The options are passed to WineSelectorAnn: n_components, n_lists,
+        n_probe (the recall/latency knob), n_candidates...
+        '''
+        self.__ensure_index()
+        self.__ann_options = options
+        self.__ann = WineSelectorAnn(**options)
+        self.__ann.build(self.__doc_matrix)
+        self.__cache.clear()
+
+    def ann_recall_report(self, requests: list[str],
+                          n_probe: int | None = None) -> dict:
+        '''
+        Compare the approximate search with the exact one for the requests.
+        Returns the mean share of the exact top n_similar found ('recall')
+        and the mean latency of both searches in milliseconds
+        '''
+        self.__ensure_index()
+        if self.__ann is None:
+            self.build_ann_index(**self.__ann_options)
+
+        rows = np.arange(self.__doc_matrix.shape[0])
+        recalls, exact_time, ann_time = [], 0.0, 0.0
+        for request in requests:
+            request_vector = self.__get_tfidf().transform([request])
+
+            start = time.perf_counter()
+            exact = self.__choose_wine(rows, request_vector)
+            exact_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            approximate = self.__choose_wine_ann(rows, request_vector, n_probe)
+            ann_time += time.perf_counter() - start
+
+            expected = {row for row, _ in exact}
+            if expected:
+                recalls.append(
+                    len(expected & {row for row, _ in approximate}) / len(expected))
+
+        return {'recall': float(np.mean(recalls)) if recalls else 1.0,
+                'exact_ms': 1000 * exact_time / max(len(requests), 1),
+                'ann_ms': 1000 * ann_time / max(len(requests), 1)}
+
+    def memory_report(self) -> dict:
+        '''
+        Memory used by the selector in bytes: the data by column, the document
+        matrix (memory-mapped from a store or private), the filter indexes,
+        the incremental ingestion state and the approximate index
+        '''
+        columns = {}
+        if self.__data is not None:
+            usage = self.__data.memory_usage(deep=True)
+            columns = {str(column): int(size) for column, size in usage.items()}
+
+        matrix = 0
+        mapped = False
+        if self.__doc_matrix is not None:
+            matrix = _nbytes(self.__doc_matrix.data, self.__doc_matrix.indices,
+                             self.__doc_matrix.indptr)
+            mapped = get_memmap(self.__doc_matrix.data) is not None
+
+        filters = _nbytes(self.__price_order, self.__price_sorted,
+                          *self.__type_rows.values())
+        incremental = _nbytes(self.__doc_freq, self.__row_epoch, self.__fingerprints,
+                              *(self.__idf_history or []))
+        ann = self.__ann.memory_usage() if self.__ann is not None else 0
+        tokens = self.__tokens.nbytes() if self.__tokens is not None else 0
+
+        report = {'data': sum(columns.values()), 'columns': columns,
+                  'doc_matrix': matrix, 'doc_matrix_mapped': mapped,
+                  'filter_indexes': filters, 'incremental': incremental, 'ann': ann,
+                  'tokens': tokens}
+        report['total'] = report['data'] + filters + incremental + ann + tokens + \
+            (0 if mapped else matrix)
+        return report
+
+    def cache_info(self) -> dict:
+        '''
+        Get the hit and miss counters and the size of the query cache
+        '''
+        return self.__cache.get_info()
+
+    def clear_cache(self):
+        '''
+        Drop the cached query results
+        '''
+        self.__cache.clear()
+
+    def select_wines(self, requests: list[str],
+                     type_filters: list[list[str] | None] | None = None,
+                     price_filters: list[list[float] | None] | None = None,
+                     batch_size: int = 256) -> pd.DataFrame:
+        '''
+        Select the wines for a batch of requests. Type and price filters are
+        optional and given per request (None means no filter).
+
+        All the requests are vectorized at once. Requests with the same filters
+        are scored together against the filtered rows of the corpus with
+        sparse products over blocks of chunk_size rows and batch_size requests,
+        so the memory used is bounded by the block size.
+
+        Result is a long-format dataframe with the top n_similar wines of every
+        request, 'request' being the position of the request in the list.
+        ValueError is raised if the filters are not given for every request
+        '''
+
+        self.__ensure_index()
+
+        for name, filters in [('type_filters', type_filters), ('price_filters', price_filters)]:
+            if filters is not None and len(filters) != len(requests):
+                raise ValueError(f"{len(filters)} {name} for {len(requests)} requests")
+        type_filters = type_filters or [None] * len(requests)
+        price_filters = price_filters or [None] * len(requests)
+
+        self.__metrics.on_counter('batch.requests', len(requests))
+        if not requests:
+            return self.__wines_frame([], [], request=[], rank=[])
+
+        # Group the requests sharing the same filters
+        groups = {}
+        for request_id, (type_filter, price_filter) in enumerate(
+                zip(type_filters, price_filters)):
+            key = (tuple(sorted(type_filter)) if type_filter else None,
+                   tuple(price_filter) if price_filter else None)
+            groups.setdefault(key, []).append(request_id)
+
+        with self.__metrics.span('batch.vectorize'):
+            request_matrix = self.__get_tfidf().transform(requests).T.tocsc()
+
+        filter_time, score_time, top_k_time = 0.0, 0.0, 0.0
+        candidates = [[] for _ in requests]
+        for cnt, request_ids in enumerate(groups.values()):
+            start = time.perf_counter()
+            rows = self.__filter_rows(type_filters[request_ids[0]],
+                                      price_filters[request_ids[0]])
+            portions = self.__split_data_to_chunks(rows)
+            filter_time += time.perf_counter() - start
+            for first in range(0, len(request_ids), batch_size):
+                batch_ids = request_ids[first: first + batch_size]
+                batch = request_matrix[:, batch_ids]
+                for portion in portions:
+                    start = time.perf_counter()
+                    block_scores = self.__score_rows(portion, batch)
+                    scored = time.perf_counter()
+                    for col, request_id in enumerate(batch_ids):
+                        best = top_k(block_scores[:, col], portion,
+                                      self.__n_similar)
+                        candidates[request_id].append(
+                            zip(portion[best].tolist(),
+                                block_scores[best, col].tolist()))
+                    score_time += scored - start
+                    top_k_time += time.perf_counter() - scored
+                self.__metrics.on_counter('batch.rows_scored', len(rows) * len(batch_ids))
+
+            self.__progress(f'\rFilter group {cnt+1} of {len(groups)} done!', end='')
+
+        self.__progress('\nDone')
+
+        start = time.perf_counter()
+        records = []
+        for request_id, request_candidates in enumerate(candidates):
+            best = heapq.merge(*request_candidates, key=lambda x: (-x[1], x[0]))
+            for rank, (row, score) in enumerate(islice(best, self.__n_similar)):
+                records.append((request_id, rank, row, score))
+        top_k_time += time.perf_counter() - start
+
+        self.__metrics.on_span('batch.filter', filter_time)
+        self.__metrics.on_span('batch.score', score_time)
+        self.__metrics.on_span('batch.top_k', top_k_time)
+        with self.__metrics.span('batch.merge'):
+            return self.__wines_frame(
+                [record[2] for record in records], [record[3] for record in records],
+                request=[record[0] for record in records],
+                rank=[record[1] for record in records])
+
+    def __reset_incremental_state(self):
+        '''
+        Forget the document frequencies and the IDF history of the previous
+        index, they are derived again from the new one on the next ingestion
+        '''
+        self.__doc_freq = None
+        self.__idf_history = None
+        self.__row_epoch = None
+
+    def __init_incremental_state(self):
+        '''
+        Derive the document frequencies from the sparsity pattern of the index,
+        all the rows being weighted with the current IDF vector
+        '''
+        if self.__doc_freq is None:
+            self.__doc_freq = np.bincount(
+                self.__doc_matrix.indices,
+                minlength=self.__doc_matrix.shape[1]).astype(np.int64)
+            self.__idf_history = [np.array(self.__get_tfidf().idf_)]
+            self.__row_epoch = np.zeros(self.__doc_matrix.shape[0], dtype=np.int32)
+        if self.__country_index is None:
+            self.__country_index = self.__utils.build_country_index(
+                self.__data['title'], self.__data['country'])
+
+    def add_reviews(self, df: pd.DataFrame, reweight: bool = False) -> int:
+        '''
+        Preprocess new raw reviews and append them to the data and the index.
+
+        Only the new rows are preprocessed and vectorized. The document
+        frequencies and the IDF vector are refreshed incrementally, new rows
+        are weighted with the refreshed IDF while the existing rows keep their
+        weights until reweight_index is called (reweight=True does it now).
+        Terms unknown to the vocabulary are ignored until the index is rebuilt,
+        measure_drift tells how far the results are from a full rebuild.
+        Reviews with the title, description, price and points of a row of the
+        data or of an earlier review are skipped.
+
+        Preprocessing, vectorizing and indexing for the filters cost time
+        proportional to the new reviews. The document matrix, the data and the
+        fingerprint and token arrays are contiguous, so they are copied once
+        per call, as are the shards of the sharded scoring: batch the reviews
+        rather than adding them one by one.
+
+        Returns the number of the added rows
+        '''
+        self.__ensure_index()
+        if (self.__doc_labels.get_indexer(df.index) >= 0).any():
+            raise ValueError("The reviews index overlaps the index of the data")
+        self.__init_incremental_state()
+
+        with self.__metrics.span('ingest.preprocess'):
+            reviews = df.copy()
+            for prefix, countries in self.__utils.build_country_index(
+                    reviews['title'], reviews['country']).items():
+                self.__country_index.setdefault(prefix, set()).update(countries)
+            n_rows = len(self.__data)
+            reviews, tokens, _ = _preprocess_rows(reviews, self.__utils, self.__country_index)
+            tokens = WineSelectorTokens(*tokens)
+
+        # New rows already in the data or repeated in the batch are dropped
+        with self.__metrics.span('ingest.dedup'):
+            fingerprints = self.__utils.get_fingerprints(reviews)
+            if self.__fingerprint_set is None:
+                self.__fingerprint_set = set(self.__get_fingerprints().tolist())
+            unique = ~pd.Index(fingerprints).duplicated() & np.fromiter(
+                (fingerprint not in self.__fingerprint_set
+                 for fingerprint in fingerprints.tolist()), dtype=bool, count=len(fingerprints))
+            reviews, fingerprints = reviews[unique], fingerprints[unique]
+            tokens.select(unique)
+        self.__metrics.on_counter('ingest.duplicates', int((~unique).sum()))
+        self.__metrics.on_counter('ingest.rows', len(reviews))
+        if reviews.empty:
+            return 0
+
+        # The sparsity pattern does not depend on the IDF weights
+        with self.__metrics.span('ingest.vectorize'):
+            vectors = self.__get_tfidf().transform(reviews['compound_description'])
+            self.__doc_freq += np.bincount(vectors.indices, minlength=len(self.__doc_freq))
+            n_docs = self.__doc_matrix.shape[0] + vectors.shape[0]
+            idf = get_idf(self.__doc_freq, n_docs, self.__tfidf_options['smooth_idf'])
+            self.__get_tfidf().idf_ = idf
+            self.__idf_history.append(idf)
+
+            vectors = self.__get_tfidf().transform(reviews['compound_description'])
+
+        with self.__metrics.span('ingest.append'):
+            self.__append_rows(reviews, vectors)
+            self.__fingerprints = np.concatenate([self.__fingerprints, fingerprints])
+            self.__fingerprint_set.update(fingerprints.tolist())
+            if self.__tokens is not None and len(self.__tokens) == n_rows:
+                self.__tokens.extend(tokens)
+
+        if reweight:
+            self.reweight_index()
+        return len(reviews)
+
+    def __append_rows(self, reviews: pd.DataFrame, vectors):
+        '''
+        Append the preprocessed reviews and their vectors to the data and the indexes
+        '''
+        if self.__compact:
+            reviews = self.__compact_frame(reviews)
+            vectors = vectors.astype(np.float32)
+        start = self.__doc_matrix.shape[0]
+        self.__doc_matrix = vstack([self.__doc_matrix, vectors], format='csr')
+        self.__row_epoch = np.concatenate([
+            self.__row_epoch,
+            np.full(vectors.shape[0], len(self.__idf_history) - 1, dtype=np.int32)])
+        if self.__ann is not None:
+            self.__ann.add(vectors)
+        self.__data = pd.concat([self.__data, reviews])
+        self.__doc_labels = self.__data.index.copy()
+        self.__extend_filter_indexes(reviews, start)
+        self.__cache.clear()
+
+    def reweight_index(self):
+        '''
+        Reweight the rows of the index with the current IDF vector. The term
+        frequencies are recovered from the IDF each row was weighted with, so
+        the text is not tokenized again
+        '''
+        if self.__row_epoch is None or len(self.__idf_history) == 1:
+            return
+
+        with self.__metrics.span('index.reweight'):
+            matrix = self.__doc_matrix
+            idf = np.array(self.__get_tfidf().idf_)
+            rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+            history = np.vstack(self.__idf_history)
+            data = matrix.data * (idf[matrix.indices] /
+                                  history[self.__row_epoch[rows], matrix.indices])
+            norms = np.sqrt(np.bincount(rows, weights=data ** 2,
+                                        minlength=matrix.shape[0]))
+            data /= norms[rows]
+
+            self.__doc_matrix = csr_matrix(
+                (data.astype(matrix.dtype), np.array(matrix.indices),
+                 np.array(matrix.indptr)), shape=matrix.shape)
+            self.__idf_history = [idf]
+            self.__row_epoch = np.zeros(matrix.shape[0], dtype=np.int32)
+            self.__shards_loaded = False
+            self.__cache.clear()
+
+    def measure_drift(self, requests: list[str]) -> dict:
+        '''
+        Compare the results of the requests with the results of a full rebuild
+        of the index over the current data. Returns the mean share of the
+        rebuilt top n_similar found by the current index ('recall'), the number
+        of the rows weighted with an older IDF vector ('stale_rows') and the
+        number of the terms missing from the current vocabulary ('new_terms')
+        '''
+        self.__ensure_index()
+        reference = WineSelector(self.__chunk_size, self.__n_similar,
+                                 verbose=self.__verbose)
+        reference.__data = self.__data
+        reference.__tokens = self.__tokens
+        reference.__stop_words = self.__stop_words
+        reference.__tfidf_options = dict(self.__tfidf_options)
+        reference.__build_index()
+
+        current = self.select_wines(requests)
+        expected = reference.select_wines(requests)
+        recalls = []
+        for request_id in range(len(requests)):
+            expected_ids = set(expected.index[expected['request'] == request_id])
+            current_ids = set(current.index[current['request'] == request_id])
+            if expected_ids:
+                recalls.append(len(expected_ids & current_ids) / len(expected_ids))
+
+        stale_rows = 0
+        if self.__row_epoch is not None:
+            stale_rows = int(np.count_nonzero(
+                self.__row_epoch != len(self.__idf_history) - 1))
+        new_terms = len(set(reference.__get_tfidf().vocabulary_) -
+                        set(self.__get_tfidf().vocabulary_))
+
+        return {'recall': float(np.mean(recalls)) if recalls else 1.0,
+                'stale_rows': stale_rows, 'new_terms': new_terms}
@@ -0,0 +1,150 @@
+'''
+WineSelectorAnn is the class that provides the approximate nearest neighbour
+search over a compact embedding of the wine descriptions
+'''
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return x / norms
+
+
+class WineSelectorAnn:
+    '''
+    WineSelectorAnn projects the TF-IDF document matrix to a dense float32
+    LSA embedding (TruncatedSVD) and indexes it with an inverted file (IVF):
+    the rows are clustered with spherical k-means and a query only scores the
+    rows of the n_probe clusters closest to it. The embedding is kept in list
+    order, so the probed lists are scored as contiguous slices. n_probe is the
+    recall/latency knob, the best n_candidates rows are returned for an exact
+    re-rank. The defaults, sqrt(N) lists with half of them probed, give a
+    recall@5 of about 0.9 on the synthetic benchmark corpora of 3k to 100k
+    random descriptions, the worst case for the clustering
+    '''
+
+    def __init__(self, n_components: int = 128, n_lists: int | None = None,
+                 n_probe: int | None = None, n_candidates: int = 100, n_iter: int = 10,
+                 random_state: int = 0):
+        self.__n_components = n_components
+        self.__n_lists = n_lists
+        self.__n_probe = n_probe
+        self.__n_candidates = n_candidates
+        self.__n_iter = n_iter
+        self.__random_state = random_state
+
+        self.__projection = None
+        self.__embedding = None
+        self.__centroids = None
+        self.__list_rows = None
+        self.__list_offsets = None
+        self.__assignment = None
+
+    def __assign(self, x: np.ndarray, batch_bytes: int = 64 * 2 ** 20) -> np.ndarray:
+        '''
+        Closest centroid of every row, computed in batches whose
+        row-to-centroid scores take at most batch_bytes
+        '''
+        batch_size = max(1, batch_bytes // (4 * len(self.__centroids)))
+        assignment = np.empty(len(x), dtype=np.int32)
+        for start in range(0, len(x), batch_size):
+            assignment[start: start + batch_size] = np.argmax(
+                x[start: start + batch_size] @ self.__centroids.T, axis=1)
+        return assignment
+
+    def __fit_centroids(self, x: np.ndarray, n_lists: int, rng):
+        '''
+        Spherical k-means over a sample of the rows
+        '''
+        sample = x[rng.choice(len(x), min(len(x), 256 * n_lists), replace=False)]
+        self.__centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(self.__n_iter):
+            assignment = self.__assign(sample)
+            membership = csr_matrix(
+                (np.ones(len(sample), dtype=np.float32),
+                 (assignment, np.arange(len(sample)))),
+                shape=(n_lists, len(sample)))
+            sums = np.asarray(membership @ sample)
+            empty = np.bincount(assignment, minlength=n_lists) == 0
+            sums[empty] = sample[rng.choice(len(sample), empty.sum())]
+            self.__centroids = _normalize(sums).astype(np.float32)
+
+    def __build_lists(self, embedding: np.ndarray):
+        '''
+        Inverted lists: the rows sorted by their cluster, the list offsets
+        and the embedding of the rows in this order
+        '''
+        self.__list_rows = np.argsort(self.__assignment, kind='stable')
+        self.__list_offsets = np.searchsorted(
+            self.__assignment[self.__list_rows], np.arange(len(self.__centroids) + 1))
+        self.__embedding = embedding[self.__list_rows]
+
+    def __project(self, matrix) -> np.ndarray:
+        '''
+        Normalized embedding of the rows of the sparse matrix
+        '''
+        return _normalize(np.asarray(matrix @ self.__projection, dtype=np.float32))
+
+    def build(self, doc_matrix):
+        '''
+        Fit the embedding and the inverted file over the document matrix
+        '''
+        from sklearn.decomposition import TruncatedSVD
+
+        rng = np.random.default_rng(self.__random_state)
+        n_components = min(self.__n_components, doc_matrix.shape[1] - 1)
+        svd = TruncatedSVD(n_components, random_state=self.__random_state)
+        svd.fit(doc_matrix)
+        self.__projection = np.ascontiguousarray(svd.components_.T, dtype=np.float32)
+        embedding = self.__project(doc_matrix)
+
+        n_lists = self.__n_lists or max(1, int(np.sqrt(doc_matrix.shape[0])))
+        self.__fit_centroids(embedding, min(n_lists, doc_matrix.shape[0]), rng)
+        self.__assignment = self.__assign(embedding)
+        self.__build_lists(embedding)
+
+    def add(self, matrix):
+        '''
+        Append the rows to the embedding and to their closest lists,
+        keeping the projection and the centroids
+        '''
+        embedding = self.__project(matrix)
+        current = np.empty_like(self.__embedding)
+        current[self.__list_rows] = self.__embedding
+        self.__assignment = np.concatenate([self.__assignment, self.__assign(embedding)])
+        self.__build_lists(np.vstack([current, embedding]))
+
+    def search(self, request_vector, n_probe: int | None = None,
+               n_candidates: int | None = None) -> np.ndarray:
+        '''
+        Sorted ids of the candidate rows for the vectorized request
+        '''
+        n_probe = min(n_probe or self.__n_probe or (len(self.__centroids) + 1) // 2,
+                      len(self.__centroids))
+        n_candidates = n_candidates or self.__n_candidates
+
+        # Only the projection rows of the request terms are touched
+        request_vector = request_vector.tocsr()
+        query = request_vector.data.astype(np.float32) @ \
+            self.__projection[request_vector.indices]
+        query /= np.linalg.norm(query) or 1
+        centroid_scores = self.__centroids @ query
+        lists = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        slices = [slice(self.__list_offsets[i], self.__list_offsets[i + 1]) for i in lists]
+        rows = np.concatenate([self.__list_rows[part] for part in slices])
+
+        if len(rows) > n_candidates:
+            scores = np.concatenate([self.__embedding[part] @ query for part in slices])
+            rows = rows[np.argpartition(-scores, n_candidates - 1)[:n_candidates]]
+        return np.sort(rows)
+
+    def memory_usage(self) -> int:
+        '''
+        Get the size of the index arrays in bytes
+        '''
+        return sum(array.nbytes for array in (
+            self.__projection, self.__embedding, self.__centroids,
+            self.__list_rows, self.__list_offsets, self.__assignment)
+            if array is not None)
@@ -0,0 +1,237 @@
+'''
+Benchmark of the WineSelector hot paths on synthetic winemag-shaped corpora.
+
+Usage:
+    python wine_selector_benchmark.py --rows 10000 100000 1000000 --output bench.json
+    python wine_selector_benchmark.py --rows 10000 --compare bench.json
+'''
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import wine_selector as ws
+from wine_selector_metrics import RecordingMetrics
+from wine_selector_utils import WineSelectorUtils
+
+COUNTRIES = ['US', 'France', 'Italy', 'Spain', 'Portugal', 'Chile', 'Argentina',
+             'Austria', 'Australia', 'Germany', 'New Zealand', 'South Africa']
+PROVINCES = ['California', 'Bordeaux', 'Tuscany', 'Northern Spain', 'Douro', 'Colchagua Valley',
+             'Mendoza Province', 'Burgenland', 'South Australia', 'Mosel', 'Marlborough', 'Stellenbosch']
+WORDS = ['aromas', 'palate', 'finish', 'acidity', 'tannins', 'ripe', 'crisp', 'juicy', 'firm',
+         'soft', 'dense', 'bright', 'round', 'elegant', 'structured', 'fresh', 'spicy', 'smoky',
+         'apple', 'pear', 'peach', 'apricot', 'citrus', 'lemon', 'lime', 'grapefruit', 'pineapple',
+         'cherry', 'plum', 'blackberry', 'raspberry', 'strawberry', 'cassis', 'currant', 'fig',
+         'vanilla', 'oak', 'toast', 'brioche', 'honey', 'butter', 'cream', 'almond', 'hazelnut',
+         'pepper', 'clove', 'cinnamon', 'licorice', 'leather', 'tobacco', 'earth', 'mineral',
+         'chocolate', 'coffee', 'mocha', 'herb', 'mint', 'sage', 'violet', 'rose', 'floral']
+REQUESTS = ['Nice, mild pear taste, hint of vanilla and apple',
+            'Dark cherry and plum with firm tannins and a smoky finish',
+            'Crisp citrus and lime, fresh mineral acidity',
+            'Toast and brioche bubbles with green apple',
+            'Ripe strawberry and raspberry, soft and juicy']
+FILTERS = [(['red', 'rose'], [50, 100]), (['white'], [10, 30]), (None, [0, 20])]
+# Cold start of a query process, from the imports to the first answer
+FIRST_ANSWER = {
+    'runtime': 'from wine_selector_runtime import WineSelectorRuntime\n'
+               'selector = WineSelectorRuntime({store!r})',
+    'selector': 'import wine_selector as ws\n'
+                'selector = ws.WineSelector(verbose=False)\n'
+                'selector.load_preprocessed_data({store!r})',
+}
+
+
+def generate_corpus(n_rows: int, fileName: str, seed: int = 0):
+    '''
+    Write a synthetic raw corpus shaped like winemag-data-130k-v2.csv, with
+    the variety names of WineSelectorUtils, null countries and duplicates
+    '''
+    rng = random.Random(seed)
+    varieties = [variety.title() for names in WineSelectorUtils().get_wine_types().values()
+                 for variety in names] + ['Zinfandel']
+    wineries = [f'{rng.choice(WORDS).title()} {rng.choice(["Estate", "Cellars", "Vineyards", "Wines"])} {i}'
+                for i in range(max(10, n_rows // 20))]
+
+    rows = []
+    for _ in range(n_rows):
+        if rows and rng.random() < 0.05:
+            rows.append(dict(rows[rng.randrange(len(rows))]))
+            continue
+        winery = rng.choice(wineries)
+        variety = rng.choice(varieties)
+        province = rng.choice(PROVINCES)
+        designation = rng.choice([None, None, 'Reserve', 'Estate', 'Brut', 'Rosé', 'White'])
+        rows.append({
+            'country': None if rng.random() < 0.01 else COUNTRIES[PROVINCES.index(province)],
+            'description': ' '.join(rng.choices(WORDS, k=rng.randint(20, 60))).capitalize() + '.',
+            'designation': designation,
+            'points': rng.randint(80, 100),
+            'price': None if rng.random() < 0.07 else float(rng.randint(5, 300)),
+            'province': province,
+            'region_1': None,
+            'region_2': None,
+            'taster_name': rng.choice([None, 'Roger Voss', 'Kerin O’Keefe', 'Paul Gregutt']),
+            'taster_twitter_handle': None,
+            'title': f'{winery} {rng.randint(1990, 2017)} {designation or ""} {variety} ({province})',
+            'variety': variety,
+            'winery': winery,
+        })
+    pd.DataFrame(rows).to_csv(fileName)
+
+
+def percentiles(timings: list[float]) -> dict:
+    '''
+    p50/p95/p99 of the timings in milliseconds
+    '''
+    values = 1000 * np.array(timings)
+    return {f'p{p}_ms': float(np.percentile(values, p)) for p in (50, 95, 99)}
+
+
+def timed(results: dict, name: str, func, *args, **kwargs):
+    '''
+    Run the function and record its wall time in seconds
+    '''
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    results[name] = time.perf_counter() - start
+    return value
+
+
+def first_answer(kind: str, store: str) -> float:
+    '''
+    Seconds from the imports to the first answer in a new interpreter
+    '''
+    script = '\n'.join(['import time', 'start = time.perf_counter()',
+                         FIRST_ANSWER[kind].format(store=store),
+                         f'selector.select_wine({REQUESTS[0]!r})',
+                         'print(time.perf_counter() - start)'])
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(output.stdout.split()[-1])
+
+
+def run_size(n_rows: int, n_queries: int, n_jobs: int | None, workdir: str,
+             compact: bool = False, score_workers: int = 1) -> dict:
+    '''
+    Benchmark all the stages on a corpus of n_rows rows, in its own process
+    so the peak RSS belongs to this size only
+    '''
+    src = os.path.join(workdir, f'corpus-{n_rows}.csv')
+    store = os.path.join(workdir, f'corpus-{n_rows}.store')
+    results = {'rows': n_rows, 'compact': compact, 'score_workers': score_workers}
+    timed(results, 'generate_s', generate_corpus, n_rows, src)
+
+    # Whole pipeline with the timings of its stages, save and load
+    metrics = RecordingMetrics()
+    selector = ws.WineSelector(cache_size=0, metrics=metrics, verbose=False, compact=compact)
+    timed(results, 'preprocess_s', selector.preprocess_data, src, n_jobs=n_jobs)
+    results['indexed_rows'] = len(selector.get_data())
+    timed(results, 'save_s', selector.save_preprocessed_data, store)
+    results.update({f'stage_{name}_s': summary['total_s']
+                    for name, summary in metrics.summary().items()})
+    del selector
+
+    for kind in FIRST_ANSWER:
+        results[f'{kind}_first_answer_s'] = first_answer(kind, store)
+
+    metrics = RecordingMetrics()
+    selector = ws.WineSelector(cache_size=0, metrics=metrics, verbose=False, compact=compact,
+                               score_workers=score_workers)
+    timed(results, 'load_s', selector.load_preprocessed_data, store)
+    timed(results, 'first_query_s', selector.select_wine, REQUESTS[0])
+
+    for name, filters in [('warm_query', [(None, None)]), ('warm_filtered_query', FILTERS)]:
+        metrics.clear()
+        for cnt in range(n_queries):
+            type_filter, price_filter = filters[cnt % len(filters)]
+            selector.select_wine(REQUESTS[cnt % len(REQUESTS)],
+                                 type_filter=type_filter, price_filter=price_filter)
+        spans = metrics.get_spans()
+        results.update({f'{name}_{key}': value
+                        for key, value in percentiles(spans.pop('query.total')).items()})
+        results.update({f'{name}_{phase}_mean_ms': 1000 * sum(values) / n_queries
+                        for phase, values in spans.items()})
+
+    # Index rebuilt from the tokens of the store, without the text
+    timed(results, 'rebuild_index_s', selector.rebuild_index)
+    results['selector_mb'] = selector.memory_report()['total'] / 2 ** 20
+    # ru_maxrss is in kilobytes on Linux
+    results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    selector.close()
+    shutil.rmtree(store, ignore_errors=True)
+    os.remove(src)
+    return results
+
+
+def get_commit() -> str | None:
+    '''
+    Current git commit of the working tree, if any
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict):
+    '''
+    Print the ratio of every timing and memory metric to the baseline
+    '''
+    baseline_sizes = {size['rows']: size for size in baseline['sizes']}
+    for size in results['sizes']:
+        reference = baseline_sizes.get(size['rows'])
+        if reference is None:
+            continue
+        print(f"\n{size['rows']} rows ({baseline.get('commit')} -> {results.get('commit')})")
+        for key, value in size.items():
+            if key.endswith(('_s', '_ms', '_mb')) and reference.get(key):
+                print(f'{key:40} {reference[key]:12.4f} {value:12.4f} {value / reference[key]:8.2f}x')
+
+
+def main():
+    '''
+    Run the benchmark for every corpus size and write the results as JSON
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='preprocessing processes, all the cores by default')
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--compact', action='store_true',
+                        help='memory-optimized selectors')
+    parser.add_argument('--score-workers', type=int, default=1,
+                        help='processes scoring the shards of the index')
+    parser.add_argument('--compare', default=None,
+                        help='results of a previous run to compare with')
+    args = parser.parse_args()
+
+    results = {'commit': get_commit(), 'cpu_count': os.cpu_count(), 'sizes': []}
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_rows in args.rows:
+            with ProcessPoolExecutor(1) as executor:
+                size = executor.submit(run_size, n_rows, args.queries, args.jobs,
+                                       workdir, args.compact, args.score_workers).result()
+            results['sizes'].append(size)
+            print(json.dumps(size, indent=2))
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+'''
+WineSelectorCache is the class that keeps the recent query results of the wine selector
+'''
+import threading
+import time
+from collections import OrderedDict
+
+
+class WineSelectorCache:
+    '''
+    WineSelectorCache is a thread-safe LRU cache with an optional time to live
+    of the entries, so it can be shared by all the sessions using one selector
+    '''
+
+    def __init__(self, max_size: int = 1024, ttl: float | None = None):
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    def get(self, key):
+        '''
+        Get the value cached for the key, None if it is missing or expired
+        '''
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and self.__ttl is not None and \
+                    time.monotonic() - entry[0] > self.__ttl:
+                del self.__entries[key]
+                entry = None
+
+            if entry is None:
+                self.__misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        '''
+        Cache the value for the key, evicting the least recently used entries
+        '''
+        if self.__max_size <= 0:
+            return
+        with self.__lock:
+            self.__entries[key] = (time.monotonic(), value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        '''
+        Drop all the entries, e.g. when the data changes
+        '''
+        with self.__lock:
+            self.__entries.clear()
+
+    def get_info(self) -> dict:
+        '''
+        Get the hit and miss counters and the size of the cache
+        '''
+        with self.__lock:
+            return {'hits': self.__hits, 'misses': self.__misses,
+                    'size': len(self.__entries), 'max_size': self.__max_size,
+                    'ttl': self.__ttl}
@@ -0,0 +1,86 @@
+'''
+Metrics hooks of the wine selector: timed spans of the preprocessing stages
+and of the query phases, and counters of the work done
+'''
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class WineSelectorMetrics:
+    '''
+    WineSelectorMetrics is the base class of the metrics hooks passed to
+    WineSelector. It ignores everything, subclasses override on_span and
+    on_counter to export the measures to a monitoring system.
+
+    Span names are '<stage>.<phase>': 'preprocess.*' for the preprocessing
+    stages, 'query.*' for select_wine (filter, vectorize, score, top_k, merge),
+    'batch.*' for select_wines, 'ingest.*' for add_reviews, 'index.*' and
+    'store.*' for the index builds and the store I/O, 'service.*' for the
+    batches of the query service
+    '''
+
+    def on_span(self, name: str, seconds: float):
+        '''
+        Called with the duration of a finished span
+        '''
+
+    def on_counter(self, name: str, value: int):
+        '''
+        Called with the increment of a counter, e.g. 'query.rows_scored'
+        '''
+
+    @contextmanager
+    def span(self, name: str):
+        '''
+        Time the block and report it as a span
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.on_span(name, time.perf_counter() - start)
+
+
+class RecordingMetrics(WineSelectorMetrics):
+    '''
+    RecordingMetrics keeps all the spans and sums the counters in memory,
+    e.g. for benchmarks or to profile slow queries
+    '''
+
+    def __init__(self):
+        self.__spans = defaultdict(list)
+        self.__counters = defaultdict(int)
+
+    def on_span(self, name: str, seconds: float):
+        self.__spans[name].append(seconds)
+
+    def on_counter(self, name: str, value: int):
+        self.__counters[name] += value
+
+    def get_spans(self) -> dict[str, list[float]]:
+        '''
+        Get the durations of all the spans in seconds by their name
+        '''
+        return dict(self.__spans)
+
+    def get_counters(self) -> dict[str, int]:
+        '''
+        Get the counters by their name
+        '''
+        return dict(self.__counters)
+
+    def summary(self) -> dict[str, dict]:
+        '''
+        Count, total and mean duration in seconds of every span
+        '''
+        return {name: {'count': len(values), 'total_s': sum(values),
+                       'mean_s': sum(values) / len(values)}
+                for name, values in self.__spans.items()}
+
+    def clear(self):
+        '''
+        Drop the recorded spans and counters
+        '''
+        self.__spans.clear()
+        self.__counters.clear()
@@ -0,0 +1,197 @@
+'''
+WineSelectorRuntime is the class that answers the wine requests from a saved
+store with NumPy and the standard library only, without pandas, SciPy or
+scikit-learn, so a query-only process starts fast
+'''
+import re
+from collections import Counter
+
+import numpy as np
+from wine_selector_cache import WineSelectorCache
+from wine_selector_store import WineSelectorStore
+
+# Default token pattern of TfidfVectorizer
+TOKEN_PATTERN = re.compile(r'(?u)\b\w\w+\b')
+TEXT_COLUMNS = ['title', 'description', 'variety']
+RUNTIME_ARRAYS = ['vocabulary', 'idf', 'stop_words', 'data', 'indices', 'indptr',
+                  'labels', 'type_codes', 'type_names', 'price', 'points'] + \
+    [f'{column}_{part}' for column in TEXT_COLUMNS for part in ('blob', 'offsets')]
+
+
+def top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> np.ndarray:
+    '''
+    Positions of the k largest scores in descending order. The selection is
+    partial and ties are broken by the smaller id, so the result is deterministic
+    '''
+    if k < len(scores):
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        candidates = np.flatnonzero(scores >= kth)
+    else:
+        candidates = np.arange(len(scores))
+    order = np.lexsort((ids[candidates], -scores[candidates]))
+    return candidates[order[:k]]
+
+
+def encode_texts(values) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    UTF-8 blob of the texts and the offsets of every text in it,
+    missing values are empty texts
+    '''
+    encoded = [value.encode() if isinstance(value, str) else b'' for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+class WineSelectorRuntime:
+    '''
+    WineSelectorRuntime loads the vocabulary, the IDF weights, the stop words,
+    the document matrix and the result columns of a store saved by
+    WineSelector.save_preprocessed_data, all memory-mapped, and answers
+    select_wine like WineSelector. Requests are tokenized and weighted like
+    the TfidfVectorizer of the selector: lowercase, the default token pattern,
+    the stop words removed, term counts (1 + log of them if sublinear_tf)
+    times IDF, L2 normalized. The results are cached like the results of
+    the selector, so the sessions sharing a runtime share its cache
+    '''
+
+    def __init__(self, fileName: str, n_similar: int = 5,
+                 cache_size: int = 1024, cache_ttl: float | None = 3600):
+        self.__n_similar = n_similar
+        self.__cache = WineSelectorCache(cache_size, cache_ttl)
+
+        store = WineSelectorStore(fileName)
+        missing = [name for name in RUNTIME_ARRAYS if not store.has_array(name)]
+        if missing:
+            raise ValueError(f"The store {fileName} has no query runtime arrays "
+                             f"{missing}, save it again")
+
+        vocabulary = store.load_array('vocabulary', mmap=False).tolist()
+        self.__vocabulary = {term: i for i, term in enumerate(vocabulary)}
+        self.__idf = store.load_array('idf', mmap=False)
+        self.__stop_words = frozenset(store.load_array('stop_words', mmap=False).tolist())
+        self.__sublinear_tf = store.get_info().get('tfidf', {}).get('sublinear_tf', False)
+
+        self.__data = store.load_array('data')
+        self.__indices = store.load_array('indices')
+        self.__indptr = store.load_array('indptr')
+        self.__empty_rows = np.flatnonzero(np.diff(self.__indptr) == 0)
+
+        self.__labels = store.load_array('labels')
+        self.__type_codes = store.load_array('type_codes')
+        self.__type_names = store.load_array('type_names', mmap=False).tolist()
+        self.__price = store.load_array('price')
+        self.__points = store.load_array('points')
+        self.__texts = {column: (store.load_array(f'{column}_blob'),
+                                 store.load_array(f'{column}_offsets'))
+                        for column in TEXT_COLUMNS}
+
+    def __analyze(self, request: str) -> list[str]:
+        '''
+        Tokens of the request without the stop words
+        '''
+        return [token for token in TOKEN_PATTERN.findall(request.lower())
+                if token not in self.__stop_words]
+
+    def vectorize(self, request: str) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Sorted vocabulary ids of the request terms and their L2-normalized
+        TF-IDF weights
+        '''
+        counts = Counter(self.__analyze(request))
+        terms = sorted((self.__vocabulary[token], count)
+                       for token, count in counts.items() if token in self.__vocabulary)
+        ids = np.array([term for term, _ in terms], dtype=np.intp)
+        weights = np.array([count for _, count in terms], dtype=np.float64)
+        if self.__sublinear_tf:
+            weights = 1 + np.log(weights)
+        weights *= self.__idf[ids]
+        norm = np.sqrt(np.dot(weights, weights))
+        if norm > 0:
+            weights /= norm
+        return ids, weights
+
+    def __filter_rows(self, type_filter: list[str] | None,
+                      price_filter: list[float] | None) -> np.ndarray | None:
+        '''
+        Sorted rows passing the type and price filters, None if there are no filters
+        '''
+        mask = None
+        if type_filter:
+            codes = [self.__type_names.index(wine_type) for wine_type in type_filter
+                     if wine_type in self.__type_names]
+            mask = np.isin(self.__type_codes, codes)
+        if price_filter:
+            priced = (self.__price >= price_filter[0]) & (self.__price <= price_filter[1])
+            mask = priced if mask is None else mask & priced
+        return None if mask is None else np.flatnonzero(mask)
+
+    def __text(self, column: str, row: int) -> str | None:
+        '''
+        Text of the row in the column, None if it is missing
+        '''
+        blob, offsets = self.__texts[column]
+        text = bytes(blob[offsets[row]: offsets[row + 1]]).decode()
+        return text or None
+
+    def select_wine(self, request: str, type_filter: list[str] | None = None,
+                    price_filter: list[float] | None = None) -> list[dict]:
+        '''
+        Select the wine by the request. Result is the list of the n_similar best
+        wines from the best match, every wine being a dict of its data index
+        label ('index'), title, description, type, price, points, variety and
+        score. The results are cached by the request tokens without the stop
+        words (their order does not change the scores) and the filters
+        '''
+        key = (tuple(sorted(self.__analyze(request))),
+               tuple(sorted(type_filter)) if type_filter else None,
+               tuple(float(price) for price in price_filter) if price_filter else None)
+        wines = self.__cache.get(key)
+        if wines is None:
+            wines = self.__select_wine(request, type_filter, price_filter)
+            self.__cache.put(key, wines)
+        return [dict(wine) for wine in wines]
+
+    def cache_info(self) -> dict:
+        '''
+        Get the hit and miss counters and the size of the query cache
+        '''
+        return self.__cache.get_info()
+
+    def __select_wine(self, request: str, type_filter: list[str] | None,
+                      price_filter: list[float] | None) -> list[dict]:
+        '''
+        Select the wine by the request, cached by select_wine
+        '''
+        ids, weights = self.vectorize(request)
+        rows = self.__filter_rows(type_filter, price_filter)
+        if rows is not None and len(rows) == 0:
+            return []
+
+        # Row sums of the products of the weights and the request weights of
+        # their terms. A trailing zero keeps the row starts in the bounds of
+        # reduceat, which gives the element at the start for the empty rows
+        vector = np.zeros(len(self.__idf), dtype=np.float64)
+        vector[ids] = weights
+        products = np.append(self.__data * vector[self.__indices], 0)
+        scores = np.add.reduceat(products, self.__indptr[:-1])
+        scores[self.__empty_rows] = 0
+        if rows is None:
+            rows = np.arange(len(scores))
+        else:
+            scores = scores[rows]
+
+        best = top_k(scores, rows, self.__n_similar)
+        wines = []
+        for row, score in zip(rows[best].tolist(), scores[best].tolist()):
+            price = float(self.__price[row])
+            points = float(self.__points[row])
+            wines.append({'index': self.__labels[row].item(),
+                          'title': self.__text('title', row),
+                          'description': self.__text('description', row),
+                          'type': self.__type_names[self.__type_codes[row]],
+                          'price': None if np.isnan(price) else price,
+                          'points': None if np.isnan(points) else int(points),
+                          'variety': self.__text('variety', row),
+                          'score': score})
+        return wines
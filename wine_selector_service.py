@@ -0,0 +1,433 @@
+'''
+Local HTTP/JSON query service sharing one wine selector between the
+sessions, and its client.
+
+Usage:
+    python wine_selector_service.py --store winemag-data-130k-v2-preprocessed.store --port 8765
+    python wine_selector_service.py --store ... --workers 4 --processes
+'''
+import argparse
+import asyncio
+import json
+import math
+import os
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from wine_selector_metrics import WineSelectorMetrics
+
+# The selector and pandas are imported by the service only, so an app
+# importing the client does not load pandas, SciPy or scikit-learn
+if TYPE_CHECKING:
+    import pandas as pd
+    import wine_selector as ws
+
+RESULT_COLUMNS = ['title', 'description', 'type', 'price', 'points', 'variety', 'score']
+STATUS_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                  408: 'Request Timeout', 413: 'Content Too Large',
+                  500: 'Internal Server Error', 503: 'Service Unavailable',
+                  504: 'Gateway Timeout'}
+# Largest JSON query body and the time to receive a whole HTTP request
+MAX_BODY_BYTES = 64 * 1024
+READ_TIMEOUT = 10.0
+
+# Selector of a worker process of the service
+_worker_selector = None
+
+
+class ServiceOverloaded(RuntimeError):
+    '''
+    Raised when the service already has max_pending queries to answer
+    '''
+
+
+class RequestTooLarge(ValueError):
+    '''
+    Raised when the body of an HTTP request is over MAX_BODY_BYTES
+    '''
+
+
+def _init_service_worker(fileName: str, compact: bool):
+    '''
+    Load the selector once per worker process. The document matrix of the
+    store is memory-mapped, so the workers share its pages
+    '''
+    import wine_selector as ws
+
+    global _worker_selector
+    _worker_selector = ws.WineSelector(cache_size=0, verbose=False, compact=compact)
+    _worker_selector.load_preprocessed_data(fileName)
+
+
+def _select_batch(queries: list[tuple], selector: 'ws.WineSelector | None' = None) -> list:
+    '''
+    Score a batch of (request, type_filter, price_filter) queries in one
+    select_wines pass and get the result records of every query. If the pass
+    fails, the queries are scored one by one and a failing query gets its
+    exception instead of the records
+    '''
+    selector = selector or _worker_selector
+    requests, type_filters, price_filters = zip(*queries)
+    try:
+        wines = selector.select_wines(list(requests), list(type_filters), list(price_filters))
+    except Exception:
+        if len(queries) == 1:
+            raise
+        results = []
+        for query in queries:
+            try:
+                results.extend(_select_batch([query], selector))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    results = [[] for _ in queries]
+    for label, row in zip(wines.index.tolist(), wines.itertuples(index=False)):
+        record = {'index': label}
+        for column in RESULT_COLUMNS:
+            value = getattr(row, column)
+            value = value.item() if hasattr(value, 'item') else value
+            # JSON has no NaN, a missing price is null
+            record[column] = None if isinstance(value, float) and math.isnan(value) else value
+        results[row.request].append(record)
+    return results
+
+
+class WineSelectorService:
+    '''
+    WineSelectorService answers the select_wine queries of many concurrent
+    clients with one shared selector.
+
+    Concurrent queries are micro-batched: a batch is closed after max_batch
+    queries or max_wait seconds and scored with one select_wines pass in a
+    pool of n_workers threads, or processes loading the store (use_processes),
+    so up to n_workers batches are scored at once. Identical queries in flight
+    share one answer. Beyond max_pending waiting queries new ones are rejected
+    (ServiceOverloaded, HTTP 503) and a query not answered within timeout
+    seconds fails (HTTP 504)
+    '''
+
+    def __init__(self, selector: 'ws.WineSelector | None' = None, fileName: str | None = None,
+                 n_workers: int = 1, use_processes: bool = False, compact: bool = True,
+                 max_batch: int = 64, max_wait: float = 0.005, max_pending: int = 1024,
+                 timeout: float = 30.0, metrics: WineSelectorMetrics | None = None):
+        if selector is None and fileName is None:
+            raise ValueError("Either a selector or the store file name is required")
+        if use_processes and fileName is None:
+            raise ValueError("Worker processes load the selector from the store file")
+
+        self.__selector = selector
+        self.__fileName = fileName
+        self.__n_workers = n_workers
+        self.__use_processes = use_processes
+        self.__compact = compact
+        self.__max_batch = max_batch
+        self.__max_wait = max_wait
+        self.__max_pending = max_pending
+        self.__timeout = timeout
+        self.__metrics = metrics or WineSelectorMetrics()
+
+        self.__executor = None
+        self.__queue = None
+        self.__slots = None
+        self.__batcher = None
+        # Futures of the queued or running queries by their key
+        self.__in_flight = {}
+
+    async def start(self):
+        '''
+        Load the selector or start the worker processes and the batcher
+        '''
+        loop = asyncio.get_running_loop()
+        if self.__use_processes:
+            self.__executor = ProcessPoolExecutor(
+                self.__n_workers, initializer=_init_service_worker,
+                initargs=(self.__fileName, self.__compact))
+            # Load the selectors now rather than on the first queries
+            await asyncio.gather(*[loop.run_in_executor(self.__executor, os.getpid)
+                                   for _ in range(self.__n_workers)])
+        else:
+            if self.__selector is None:
+                import wine_selector as ws
+
+                self.__selector = ws.WineSelector(cache_size=0, verbose=False,
+                                                  compact=self.__compact)
+                await loop.run_in_executor(
+                    None, self.__selector.load_preprocessed_data, self.__fileName)
+            self.__executor = ThreadPoolExecutor(self.__n_workers)
+
+        self.__queue = asyncio.Queue()
+        self.__slots = asyncio.Semaphore(self.__n_workers)
+        self.__batcher = asyncio.create_task(self.__run_batcher())
+
+    async def stop(self):
+        '''
+        Stop the batcher and the workers, the waiting queries are cancelled
+        '''
+        self.__batcher.cancel()
+        for future in self.__in_flight.values():
+            future.cancel()
+        self.__in_flight.clear()
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_info(self) -> dict:
+        '''
+        Get the number of the queries in flight and the service settings
+        '''
+        return {'in_flight': len(self.__in_flight), 'max_pending': self.__max_pending,
+                'n_workers': self.__n_workers, 'use_processes': self.__use_processes,
+                'max_batch': self.__max_batch, 'max_wait': self.__max_wait}
+
+    async def select_wine(self, request: str, type_filter: list[str] | None = None,
+                          price_filter: list[float] | None = None) -> list[dict]:
+        '''
+        Select the wine by the request, the result records are sorted by score.
+        ValueError is raised for a request that is not a string, a type filter
+        that is not a list of strings or a price filter that is not two numbers
+        '''
+        self.__validate(request, type_filter, price_filter)
+        key = (' '.join(request.lower().split()),
+               tuple(sorted(type_filter)) if type_filter else None,
+               tuple(float(price) for price in price_filter) if price_filter else None)
+
+        future = self.__in_flight.get(key)
+        if future is not None:
+            self.__metrics.on_counter('service.coalesced', 1)
+        else:
+            if len(self.__in_flight) >= self.__max_pending:
+                self.__metrics.on_counter('service.rejected', 1)
+                raise ServiceOverloaded(f"{len(self.__in_flight)} queries are pending")
+            future = asyncio.get_running_loop().create_future()
+            self.__in_flight[key] = future
+            self.__queue.put_nowait((key, future))
+
+        try:
+            # A timed out query does not cancel the answer of the identical ones
+            return await asyncio.wait_for(asyncio.shield(future), self.__timeout)
+        except asyncio.TimeoutError:
+            self.__metrics.on_counter('service.timeouts', 1)
+            raise
+
+    @staticmethod
+    def __validate(request, type_filter, price_filter):
+        '''
+        Check the query before it is batched, so it cannot fail the other
+        queries of its batch
+        '''
+        if not isinstance(request, str):
+            raise ValueError("'request' must be a string")
+        if type_filter is not None and (
+                not isinstance(type_filter, (list, tuple)) or
+                not all(isinstance(wine_type, str) for wine_type in type_filter)):
+            raise ValueError("'type_filter' must be a list of wine types")
+        if price_filter is not None and (
+                not isinstance(price_filter, (list, tuple)) or len(price_filter) != 2 or
+                not all(isinstance(price, (int, float)) and not isinstance(price, bool)
+                        for price in price_filter)):
+            raise ValueError("'price_filter' must be a list of two prices [min, max]")
+
+    async def __run_batcher(self):
+        '''
+        Collect the queued queries to batches and score them,
+        at most n_workers batches at once
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.__queue.get()]
+            deadline = loop.time() + self.__max_wait
+            while len(batch) < self.__max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.__queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self.__slots.acquire()
+            asyncio.create_task(self.__score_batch(batch))
+
+    async def __score_batch(self, batch: list[tuple]):
+        '''
+        Score the batch in the pool and answer its queries
+        '''
+        queries = [key for key, _ in batch]
+        self.__metrics.on_counter('service.batches', 1)
+        self.__metrics.on_counter('service.queries', len(batch))
+        try:
+            with self.__metrics.span('service.score'):
+                if self.__use_processes:
+                    call = (_select_batch, queries)
+                else:
+                    call = (_select_batch, queries, self.__selector)
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self.__executor, *call)
+        except Exception as e:
+            results = [e] * len(batch)
+        finally:
+            self.__slots.release()
+
+        for (key, future), result in zip(batch, results):
+            self.__in_flight.pop(key, None)
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        '''
+        Answer one HTTP request: POST /select with a JSON body
+        {"request": ..., "type_filter": [...], "price_filter": [min, max]},
+        GET /health
+        '''
+        try:
+            method, path, body = await asyncio.wait_for(
+                self.__read_request(reader), READ_TIMEOUT)
+
+            if method == 'GET' and path == '/health':
+                status, answer = 200, {'status': 'ok', **self.get_info()}
+            elif method == 'POST' and path == '/select':
+                query = json.loads(body or b'{}')
+                if not isinstance(query, dict):
+                    raise ValueError("the query must be a JSON object")
+                try:
+                    wines = await self.select_wine(query['request'], query.get('type_filter'),
+                                                   query.get('price_filter'))
+                    status, answer = 200, {'wines': wines}
+                except ServiceOverloaded as e:
+                    status, answer = 503, {'error': str(e)}
+                except asyncio.TimeoutError:
+                    status, answer = 504, {'error': f"No answer in {self.__timeout}s"}
+            else:
+                status, answer = 404, {'error': f"Unknown route {method} {path}"}
+        except RequestTooLarge as e:
+            status, answer = 413, {'error': str(e)}
+        except asyncio.TimeoutError:
+            status, answer = 408, {'error': f"Request not received in {READ_TIMEOUT}s"}
+        except (ValueError, KeyError, TypeError) as e:
+            status, answer = 400, {'error': f"Bad request: {e}"}
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception as e:
+            status, answer = 500, {'error': f"{type(e).__name__}: {e}"}
+
+        payload = json.dumps(answer).encode()
+        writer.write(f'HTTP/1.1 {status} {STATUS_REASONS[status]}\r\n'
+                     f'Content-Type: application/json\r\n'
+                     f'Content-Length: {len(payload)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode() + payload)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    @staticmethod
+    async def __read_request(reader: asyncio.StreamReader) -> tuple[str, str, bytes]:
+        '''
+        Read the method, the path and the body of an HTTP request,
+        the body being at most MAX_BODY_BYTES
+        '''
+        method, path, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+        headers = {}
+        while (line := (await reader.readline()).decode('latin-1').strip()):
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length < 0:
+            raise ValueError(f"Invalid Content-Length {length}")
+        if length > MAX_BODY_BYTES:
+            raise RequestTooLarge(f"The body is over {MAX_BODY_BYTES} bytes")
+        return method, path, await reader.readexactly(length)
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8765):
+        '''
+        Start the service and answer the HTTP requests until cancelled
+        '''
+        await self.start()
+        server = await asyncio.start_server(self.__handle, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.stop()
+
+
+class WineSelectorClient:
+    '''
+    WineSelectorClient queries a running WineSelectorService, its select_wine
+    returns the same dataframe as WineSelector.select_wine
+    '''
+
+    def __init__(self, url: str = 'http://127.0.0.1:8765', timeout: float = 60.0):
+        self.__url = url.rstrip('/')
+        self.__timeout = timeout
+
+    def __call(self, path: str, query: dict | None = None) -> dict:
+        '''
+        Send the query and get the JSON answer, the service errors are
+        raised as RuntimeError
+        '''
+        data = json.dumps(query).encode() if query is not None else None
+        request = urllib.request.Request(self.__url + path, data=data,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.__timeout) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"Wine selector service error {e.code}: "
+                               f"{json.load(e).get('error')}") from e
+
+    def health(self) -> dict:
+        '''
+        Get the state of the service
+        '''
+        return self.__call('/health')
+
+    def select_wine(self, request: str, type_filter: list[str] | None = None,
+                    price_filter: list[float] | None = None) -> 'pd.DataFrame':
+        '''
+        Select the wine by the request
+        '''
+        import pandas as pd
+
+        wines = self.__call('/select', {'request': request, 'type_filter': type_filter,
+                                        'price_filter': price_filter})['wines']
+        return pd.DataFrame(wines, columns=['index'] + RESULT_COLUMNS).set_index('index')
+
+
+def main():
+    '''
+    Run the service over a preprocessed store
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--store', required=True, help='preprocessed store of the selector')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--processes', action='store_true',
+                        help='score in worker processes instead of threads')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    parser.add_argument('--max-pending', type=int, default=1024)
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+
+    service = WineSelectorService(
+        fileName=args.store, n_workers=args.workers, use_processes=args.processes,
+        max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000,
+        max_pending=args.max_pending, timeout=args.timeout)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+'''
+WineSelectorShards is the class that scores a query over row shards of the
+document matrix in parallel
+'''
+import heapq
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from wine_selector_runtime import top_k
+from wine_selector_store import get_memmap
+
+# Arrays attached by a worker process: the key of the published arrays,
+# the arrays by name and the shared memory blocks holding them
+_worker_key = None
+_worker_arrays = {}
+_worker_blocks = []
+
+
+def _mapped_file(array: np.ndarray):
+    '''
+    File name and offset of the array if it is the whole array of a
+    memory-mapped file, e.g. of a store, else None
+    '''
+    base = get_memmap(array)
+    if base is None or base.filename is None or base.nbytes != array.nbytes or \
+            base.ctypes.data != array.ctypes.data:
+        return None
+    return base.filename, base.offset
+
+
+def _attach_arrays(key: tuple, specs: dict):
+    '''
+    Attach the worker to the published arrays, once per key
+    '''
+    global _worker_key, _worker_arrays, _worker_blocks
+    if key == _worker_key:
+        return
+    # The views must be released before their blocks are closed
+    _worker_arrays = {}
+    for block in _worker_blocks:
+        block.close()
+    _worker_blocks = []
+
+    for name, (kind, location, offset, dtype, shape) in specs.items():
+        if kind == 'shm':
+            block = shared_memory.SharedMemory(location)
+            _worker_blocks.append(block)
+            _worker_arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)
+        else:
+            _worker_arrays[name] = np.memmap(location, dtype, 'r', offset, shape)
+    _worker_key = key
+
+
+def _score_shard(key: tuple, specs: dict, n_cols: int, start: int, stop: int,
+                 query_indices: np.ndarray, query_data: np.ndarray,
+                 type_codes: np.ndarray | None, price_filter: tuple | None,
+                 k: int) -> tuple:
+    '''
+    Apply the filters to the rows start:stop of the document matrix, score
+    them against the query and get the rows and scores of the local top-k
+    and the number of the scored rows
+    '''
+    _attach_arrays(key, specs)
+    indptr = _worker_arrays['indptr'][start: stop + 1]
+    first, last = indptr[0], indptr[-1]
+    matrix = csr_matrix((_worker_arrays['data'][first: last],
+                         _worker_arrays['indices'][first: last], indptr - first),
+                        shape=(stop - start, n_cols))
+
+    mask = None
+    if type_codes is not None:
+        mask = np.isin(_worker_arrays['types'][start: stop], type_codes)
+    if price_filter is not None:
+        price = _worker_arrays['price'][start: stop]
+        priced = (price >= price_filter[0]) & (price <= price_filter[1])
+        mask = priced if mask is None else mask & priced
+
+    rows = np.arange(start, stop)
+    if mask is not None:
+        local = np.flatnonzero(mask)
+        if len(local) == 0:
+            return [], [], 0
+        matrix, rows = matrix[local], rows[local]
+
+    vector = np.zeros(n_cols, dtype=matrix.dtype)
+    vector[query_indices] = query_data
+    scores = matrix @ vector
+    best = top_k(scores, rows, k)
+    return rows[best].tolist(), scores[best].tolist(), len(rows)
+
+
+class WineSelectorShards:
+    '''
+    WineSelectorShards splits the document matrix into n_workers row shards
+    of about the same number of non-zeros and scores a query with a persistent
+    pool of n_workers processes, one task per shard. The matrix and the
+    filter columns (type codes, prices) are published once per index version:
+    arrays memory-mapped from a store are mapped by the workers from the same
+    file, the others are copied to shared memory, so the workers attach to
+    them without copying. The type and price filters are applied by the
+    workers to their shards and every shard returns its local top-k
+    '''
+
+    def __init__(self, n_workers: int):
+        self.__n_workers = n_workers
+        self.__executor = None
+        self.__blocks = []
+        self.__specs = None
+        self.__key = None
+        self.__n_cols = 0
+        self.__shards = []
+        self.__type_codes = {}
+        self.__version = 0
+        self.__finalizer = None
+
+    def __publish(self, name: str, array: np.ndarray):
+        '''
+        Describe the array to the workers, copying it to shared memory
+        unless it is memory-mapped from a file
+        '''
+        mapped = _mapped_file(array)
+        if mapped is not None:
+            self.__specs[name] = ('file', mapped[0], mapped[1], array.dtype.str, array.shape)
+            return
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+        self.__blocks.append(block)
+        self.__specs[name] = ('shm', block.name, 0, array.dtype.str, array.shape)
+
+    def load(self, doc_matrix, types: pd.Series, price: np.ndarray):
+        '''
+        Publish a new version of the document matrix and of the filter
+        columns, starting the worker pool on the first call
+        '''
+        self.__release()
+        codes, uniques = pd.factorize(types.astype(object))
+        self.__type_codes = {wine_type: code for code, wine_type in enumerate(uniques)}
+        self.__specs = {}
+        for name, array in [('data', doc_matrix.data), ('indices', doc_matrix.indices),
+                            ('indptr', doc_matrix.indptr),
+                            ('types', codes.astype(np.int16)),
+                            ('price', np.asarray(price, dtype=np.float64))]:
+            self.__publish(name, array)
+
+        self.__version += 1
+        self.__key = (id(self), self.__version)
+        self.__n_cols = doc_matrix.shape[1]
+        bounds = np.searchsorted(doc_matrix.indptr,
+                                 np.linspace(0, doc_matrix.nnz, self.__n_workers + 1))
+        bounds[0], bounds[-1] = 0, doc_matrix.shape[0]
+        bounds = np.unique(np.clip(bounds, 0, doc_matrix.shape[0]))
+        self.__shards = [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        if self.__executor is None:
+            self.__executor = ProcessPoolExecutor(self.__n_workers)
+            self.__finalizer = weakref.finalize(
+                self, WineSelectorShards.__shutdown, self.__executor, self.__blocks)
+
+    def search(self, request_vector, type_filter: list[str] | None,
+               price_filter: list[float] | None, k: int) -> tuple[list, int]:
+        '''
+        The k best (row, score) pairs of the rows passing the filters
+        and the number of the scored rows
+        '''
+        request_vector = request_vector.tocsr()
+        type_codes = None
+        if type_filter:
+            type_codes = np.array([self.__type_codes[wine_type] for wine_type in type_filter
+                                   if wine_type in self.__type_codes], dtype=np.int16)
+        price_filter = (float(price_filter[0]), float(price_filter[1])) \
+            if price_filter else None
+
+        futures = [self.__executor.submit(
+            _score_shard, self.__key, self.__specs, self.__n_cols, start, stop,
+            request_vector.indices, request_vector.data, type_codes, price_filter, k)
+            for start, stop in self.__shards]
+        results = [future.result() for future in futures]
+
+        best = heapq.merge(*[zip(rows, scores) for rows, scores, _ in results],
+                           key=lambda x: (-x[1], x[0]))
+        return list(islice(best, k)), sum(n_rows for _, _, n_rows in results)
+
+    def __release(self):
+        '''
+        Unlink the shared memory of the previous version, the workers
+        keep their mappings until they attach to the new one
+        '''
+        for block in self.__blocks:
+            block.close()
+            block.unlink()
+        self.__blocks.clear()
+
+    @staticmethod
+    def __shutdown(executor: ProcessPoolExecutor, blocks: list):
+        executor.shutdown(wait=False, cancel_futures=True)
+        for block in blocks:
+            block.close()
+            block.unlink()
+        blocks.clear()
+
+    def close(self):
+        '''
+        Stop the workers and free the shared memory
+        '''
+        if self.__finalizer is not None:
+            self.__finalizer()
+        self.__executor = None
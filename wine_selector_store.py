@@ -0,0 +1,133 @@
+'''
+WineSelectorStore is the class that keeps the preprocessed data and the search
+index on disk in a binary, memory-mappable format
+'''
+import json
+import os
+import shutil
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+# pandas is imported to load the metadata only, so the query runtime
+# reads the arrays of a store without it
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def get_memmap(array: np.ndarray | None) -> np.memmap | None:
+    '''
+    Memory-mapped file array the array is a view of, e.g. an array of a
+    store, None if it is not mapped
+    '''
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return array
+        array = getattr(array, 'base', None)
+    return None
+
+
+class WineSelectorStore:
+    '''
+    WineSelectorStore is a versioned directory with the columnar metadata of the
+    wines in Parquet and the index arrays (vocabulary, IDF vector, CSR document
+    matrix...) as raw .npy files, which are opened with np.memmap so the worker
+    processes share their pages instead of holding private copies
+    '''
+
+    FORMAT = 'wine-selector-store'
+    VERSION = 1
+
+    def __init__(self, path: str):
+        self.__path = path
+        self.__manifest = None
+
+    def __file(self, name: str) -> str:
+        return os.path.join(self.__path, name)
+
+    def exists(self) -> bool:
+        '''
+        Check if the store was saved at the path
+        '''
+        return os.path.isfile(self.__file('manifest.json'))
+
+    def __is_store(self) -> bool:
+        '''
+        Check if the path holds a store of any version, which may be replaced
+        '''
+        try:
+            with open(self.__file('manifest.json'), encoding='utf-8') as f:
+                return json.load(f).get('format') == self.FORMAT
+        except (OSError, ValueError, AttributeError):
+            return False
+
+    def save(self, data: 'pd.DataFrame', arrays: dict[str, np.ndarray], info: dict):
+        '''
+        Save the data, the arrays and the info describing them. The store is
+        written aside and moved in place when complete, only a previous
+        store is replaced
+        '''
+        if os.path.lexists(self.__path) and not self.__is_store():
+            raise ValueError(f"{self.__path} exists and is not a wine selector store")
+
+        tmp_path = self.__path.rstrip(os.sep) + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        data.to_parquet(os.path.join(tmp_path, 'metadata.parquet'), index=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f'{name}.npy'),
+                    np.ascontiguousarray(array), allow_pickle=False)
+
+        manifest = {'format': self.FORMAT, 'version': self.VERSION,
+                    'arrays': sorted(arrays), 'info': info}
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+        if os.path.islink(self.__path):
+            os.unlink(self.__path)
+        elif os.path.lexists(self.__path):
+            shutil.rmtree(self.__path)
+        os.rename(tmp_path, self.__path)
+        self.__manifest = manifest
+
+    def __get_manifest(self) -> dict:
+        if self.__manifest is None:
+            with open(self.__file('manifest.json'), encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('format') != self.FORMAT or manifest.get('version') != self.VERSION:
+                raise ValueError(
+                    f"Unsupported store format in {self.__path}: "
+                    f"{manifest.get('format')} v{manifest.get('version')}")
+            self.__manifest = manifest
+        return self.__manifest
+
+    def get_info(self) -> dict:
+        '''
+        Get the info saved with the store
+        '''
+        return self.__get_manifest()['info']
+
+    def has_array(self, name: str) -> bool:
+        '''
+        Check if the array was saved in the store
+        '''
+        return name in self.__get_manifest()['arrays']
+
+    def load_data(self, columns: list[str] | None = None) -> 'pd.DataFrame':
+        '''
+        Load the metadata of the wines, all the columns if none are given
+        '''
+        import pandas as pd
+
+        self.__get_manifest()
+        return pd.read_parquet(self.__file('metadata.parquet'), columns=columns)
+
+    def load_array(self, name: str, mmap: bool = True) -> np.ndarray:
+        '''
+        Load the array, memory-mapped read-only by default
+        '''
+        if not self.has_array(name):
+            raise KeyError(f"No array '{name}' in the store {self.__path}")
+        return np.load(self.__file(f'{name}.npy'),
+                       mmap_mode='r' if mmap else None, allow_pickle=False)
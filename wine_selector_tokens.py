@@ -0,0 +1,122 @@
+'''
+WineSelectorTokens is the class that keeps the tokenized corpus of the wine
+selector as integer arrays, so the index is rebuilt without the text
+'''
+import numpy as np
+from scipy.sparse import csr_matrix
+from wine_selector_runtime import TOKEN_PATTERN
+
+
+def get_idf(doc_freq: np.ndarray, n_docs: int, smooth_idf: bool = True) -> np.ndarray:
+    '''
+    IDF weights of the terms with the document frequencies, as computed by
+    TfidfVectorizer: smooth_idf adds one document containing every term
+    '''
+    return np.log((n_docs + int(smooth_idf)) / (doc_freq + int(smooth_idf))) + 1
+
+
+def tokenize(texts) -> tuple[list[str], np.ndarray, np.ndarray]:
+    '''
+    Tokenize the texts like TfidfVectorizer without stop words: lowercase and
+    the default token pattern. Returns the vocabulary of the texts, the token
+    ids of all the texts and the offsets of every text in them
+    '''
+    vocabulary = {}
+    ids = []
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    for cnt, text in enumerate(texts):
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        ids.extend([vocabulary.setdefault(token, len(vocabulary)) for token in tokens])
+        offsets[cnt + 1] = len(ids)
+    return list(vocabulary), np.array(ids, dtype=np.int32), offsets
+
+
+class WineSelectorTokens:
+    '''
+    WineSelectorTokens is a CSR-style token array of the documents: the token
+    ids of all the documents, the offsets of every document in them and the
+    vocabulary shared by the documents, stop words included. The TF-IDF
+    matrix is computed from the integer arrays for any stop words and
+    weighting options of TfidfVectorizer
+    '''
+
+    def __init__(self, vocabulary: list[str] | None = None, ids: np.ndarray | None = None,
+                 offsets: np.ndarray | None = None):
+        self.__vocabulary = list(vocabulary or [])
+        self.__token_ids = {token: i for i, token in enumerate(self.__vocabulary)}
+        self.__ids = ids if ids is not None else np.empty(0, dtype=np.int32)
+        self.__offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.__offsets) - 1
+
+    def get_arrays(self) -> dict[str, np.ndarray]:
+        '''
+        Get the arrays to save
+        '''
+        return {'token_vocabulary': np.array(self.__vocabulary, dtype=str),
+                'token_ids': self.__ids, 'token_offsets': self.__offsets}
+
+    def nbytes(self) -> int:
+        '''
+        Get the size of the token arrays in bytes
+        '''
+        return self.__ids.nbytes + self.__offsets.nbytes
+
+    def append(self, vocabulary: list[str], ids: np.ndarray, offsets: np.ndarray):
+        '''
+        Append the documents tokenized with their own vocabulary
+        '''
+        mapping = np.array([self.__token_ids.setdefault(token, len(self.__token_ids))
+                            for token in vocabulary], dtype=np.int32)
+        self.__vocabulary.extend(vocabulary[i] for i in np.flatnonzero(
+            mapping >= len(self.__vocabulary)))
+        self.__ids = np.concatenate([self.__ids, mapping[ids] if len(ids) else ids])
+        self.__offsets = np.concatenate([self.__offsets, self.__offsets[-1] + offsets[1:]])
+
+    def extend(self, tokens: 'WineSelectorTokens'):
+        '''
+        Append the documents of other tokens
+        '''
+        self.append(tokens.__vocabulary, tokens.__ids, tokens.__offsets)
+
+    def select(self, mask: np.ndarray):
+        '''
+        Keep the documents of the boolean mask
+        '''
+        lengths = np.diff(self.__offsets)
+        self.__ids = self.__ids[np.repeat(mask, lengths)]
+        self.__offsets = np.concatenate([[0], np.cumsum(lengths[mask])]).astype(np.int64)
+
+    def tfidf(self, stop_words, sublinear_tf: bool = False,
+              smooth_idf: bool = True) -> tuple[csr_matrix, list[str], np.ndarray]:
+        '''
+        L2-normalized TF-IDF matrix of the documents, the sorted terms of its
+        columns and their IDF weights, as computed by TfidfVectorizer.fit_transform
+        '''
+        vocabulary = np.array(self.__vocabulary, dtype=str)
+        kept = ~np.isin(vocabulary, list(stop_words))
+
+        # Term counts of the kept tokens, duplicates being summed by the CSR build
+        rows = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.__offsets))
+        keep = kept[self.__ids]
+        counts = csr_matrix((np.ones(np.count_nonzero(keep)), (rows[keep], self.__ids[keep])),
+                            shape=(len(self), len(vocabulary)))
+        counts.sum_duplicates()
+
+        # The columns are the terms found in the documents in alphabetical order
+        doc_freq = np.bincount(counts.indices, minlength=len(vocabulary))
+        terms = np.flatnonzero(doc_freq > 0)
+        terms = terms[np.argsort(vocabulary[terms], kind='stable')]
+        matrix = counts[:, terms].tocsr()
+        matrix.sort_indices()
+
+        idf = get_idf(doc_freq[terms], len(self), smooth_idf)
+        if sublinear_tf:
+            np.log(matrix.data, out=matrix.data)
+            matrix.data += 1
+        matrix.data *= idf[matrix.indices]
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        matrix.data /= np.repeat(norms, np.diff(matrix.indptr))
+        return matrix, vocabulary[terms].tolist(), idf
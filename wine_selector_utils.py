@@ -1,7 +1,10 @@
 '''
 Utility class for the wine selector
 '''
-from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+import re
+
+import numpy as np
+import pandas as pd
 
 
 class WineSelectorUtils:
@@ -43,16 +46,23 @@ class WineSelectorUtils:
             'sparkling': sparkling
         }
 
-        type_custom_stopwords = ['wine', 'red', 'flavors', 'blend', 'rosé', 'acidity', 'de',
-                                 'sparkling', 'champagne', 'white', 'blanc', 'aromas', 'valley',
-                                 'tannins', 'palate', 'nv', 'finish', 'drink', 'california',
-                                 'provence', 'château', 'côtes', 'cabernet', 'pinot', 'sauvingon',
-                                 'vineyard', 'notes', 'brut', 'cava', 'cuvée', 'nose',
-                                 'noir', 'fruit', 'fruity', 'fruits', 'dry', 'texture',
-                                 'color', 'touch', 'well', 'balanced', 'character',
-                                 'sauvignon', 'offers', 'fine', 'full', 'fine',
-                                 'made', 'good', 'years', 'la', 'shows', 'sample', 'rich']
-        self.__stop_words = ENGLISH_STOP_WORDS.union(type_custom_stopwords)
+        # One compiled multi-pattern matcher per wine type: any of the lower
+        # case variety names found anywhere in the text
+        self.__type_patterns = {
+            key: re.compile('|'.join(re.escape(item.lower()) for item in value))
+            for key, value in self.__wine_types.items()
+        }
+
+        self.__custom_stop_words = ['wine', 'red', 'flavors', 'blend', 'rosé', 'acidity', 'de',
+                                    'sparkling', 'champagne', 'white', 'blanc', 'aromas',
+                                    'valley', 'tannins', 'palate', 'nv', 'finish', 'drink',
+                                    'california', 'provence', 'château', 'côtes', 'cabernet',
+                                    'pinot', 'sauvingon', 'vineyard', 'notes', 'brut', 'cava',
+                                    'cuvée', 'nose', 'noir', 'fruit', 'fruity', 'fruits',
+                                    'dry', 'texture', 'color', 'touch', 'well', 'balanced',
+                                    'character', 'sauvignon', 'offers', 'fine', 'full', 'fine',
+                                    'made', 'good', 'years', 'la', 'shows', 'sample', 'rich']
+        self.__stop_words = None
 
     def __check_if_any_of_list(self, row, columns, lst):
         for col in columns:
@@ -69,10 +79,57 @@ class WineSelectorUtils:
                 return key
         return None
 
+    def __get_wine_types(self, df, column):
+        '''
+        Wine type of every row found in the column, None if there is no match.
+        The types are checked in order, so the first matching one wins
+        '''
+        types = pd.Series(None, index=df.index, dtype=object)
+        if column not in df or not (pd.api.types.is_object_dtype(df[column]) or
+                                    pd.api.types.is_string_dtype(df[column])):
+            return types
+
+        values = df[column].str.lower()
+        for key, pattern in reversed(self.__type_patterns.items()):
+            types[values.str.contains(pattern, na=False)] = key
+        return types
+
     def assign_wine_types(self, df):
         '''
         Assign wine types to the dataframe
         '''
+        # Check wine types based on designation, title and variety, in that priority
+        type_by_variety = self.__get_wine_types(df, 'variety')
+        type_by_title = self.__get_wine_types(df, 'title')
+        type_by_design = self.__get_wine_types(df, 'designation')
+
+        df['type'] = type_by_design.combine_first(
+            type_by_title).combine_first(type_by_variety).fillna('unknown')
+
+        # The columns are lowercased once for the zinfandel corrections
+        zinfandel = df['variety'].str.lower().str.contains('zinfandel', regex=False, na=False)
+        if zinfandel.any():
+            designation = df['designation'].str.lower()
+            df.loc[zinfandel & designation.str.contains('rosé', regex=False, na=False),
+                   'type'] = 'rose'
+            df.loc[zinfandel & designation.str.contains('white ', regex=False, na=False),
+                   'type'] = 'white'
+            df.loc[zinfandel & (df['type'] == 'unknown'), 'type'] = 'red'
+
+        return df
+
+    def assign_wine_types_fast(self, df):
+        '''
+        Assign wine types to the dataframe. Kept for compatibility,
+        assign_wine_types is vectorized now
+        '''
+        return self.assign_wine_types(df)
+
+    def assign_wine_types_slow(self, df):
+        '''
+        Assign wine types to the dataframe row by row. Reference implementation
+        of assign_wine_types, kept to check the parity of the results
+        '''
         for index, row in df.iterrows():
             # Check variety field
             type_by_variety = self.__get_wine_type(row, 'variety')
@@ -100,37 +157,64 @@ class WineSelectorUtils:
 
         return df
 
-    def assign_wine_types_fast(self, df):
+    def get_title_prefixes(self, titles: pd.Series) -> pd.Series:
         '''
-        Assign wine types to the dataframe
+        Normalized first words of the titles before the digits representing the
+        year, NaN if the title has no year
         '''
-        # Check wine types based on variety, title, and designation
-        type_by_variety = df.apply(
-            lambda row: self.__get_wine_type(row, 'variety'), axis=1)
-        type_by_title = df.apply(
-            lambda row: self.__get_wine_type(row, 'title'), axis=1)
-        type_by_design = df.apply(
-            lambda row: self.__get_wine_type(row, 'designation'), axis=1)
+        prefixes = titles.str.extract(
+            r"^(.*?)(?=\b\d{4}\b)", expand=False).str.strip().str.lower()
+        return prefixes.where(prefixes != '')
 
-        # Assign the final type based on priority
-        df['type'] = type_by_design.combine_first(
-            type_by_title).combine_first(type_by_variety).fillna('unknown')
+    def build_country_index(self, titles: pd.Series, countries: pd.Series) -> dict:
+        '''
+        Index of the title prefixes to the set of the known countries
+        of the wines with this prefix
+        '''
+        # Categorical countries (compact mode) are grouped as plain values
+        known = pd.DataFrame({'prefix': self.get_title_prefixes(titles),
+                              'country': countries.astype(object)}).dropna().drop_duplicates()
+        return known.groupby('prefix')['country'].agg(set).to_dict()
 
-        # Further refinement based on specific conditions
-        zinfandel_mask = df['variety'].str.contains(
-            'zinfandel', case=False, na=False)
-        rose_mask = df['designation'].str.contains(
-            'rosé', case=False, na=False, regex=True)
-        white_mask = df['designation'].str.contains(
-            'white', case=False, na=False, regex=True)
-        unknown_mask = df['type'].str.contains(
-            'unknown', case=False, na=False, regex=True)
+    def fill_countries(self, df, country_index: dict):
+        '''
+        Fill the null countries of the dataframe by the title prefix index
+        if the prefix is known with exactly one country
+        '''
+        nulls = df['country'].isnull()
+        if not nulls.any():
+            return df
+
+        unique = {prefix: next(iter(countries))
+                  for prefix, countries in country_index.items() if len(countries) == 1}
+        countries = self.get_title_prefixes(df.loc[nulls, 'title']).map(unique)
+        found = countries.notna().to_numpy()
+        nulls[nulls] = found
+        df.loc[nulls, 'country'] = countries[found].to_numpy()
+        return df
 
-        df.loc[zinfandel_mask & rose_mask, 'type'] = 'rose'
-        df.loc[zinfandel_mask & white_mask, 'type'] = 'white'
-        df.loc[zinfandel_mask & unknown_mask, 'type'] = 'red'
+    def get_fingerprints(self, df: pd.DataFrame,
+                         columns: tuple = ('title', 'description', 'price', 'points')) -> np.ndarray:
+        '''
+        64-bit fingerprints of the rows over the dedup key columns. The text
+        columns are hashed as objects and the numbers as float64 rounded to
+        cents, so the fingerprints do not depend on the dtypes of the compact mode
+        '''
+        key = pd.DataFrame({column: df[column].astype(object)
+                            if column in ('title', 'description')
+                            else pd.to_numeric(df[column]).astype(np.float64).round(2)
+                            for column in columns}, index=df.index)
+        return pd.util.hash_pandas_object(key, index=False).to_numpy()
 
-        return df
+    def get_compound_description(self, df) -> pd.Series:
+        '''
+        Description, variety, province and title of the wines joined in one text
+        '''
+        cols = ['description', 'variety', 'province', 'title']
+        compound = df[cols[0]].astype(str).fillna('nan')
+        for col in cols[1:]:
+            compound = compound + ' ' + df[col].astype(str).fillna('nan')
+        return compound
 
     def get_wine_types(self):
         '''
@@ -140,6 +224,10 @@ class WineSelectorUtils:
 
     def get_stop_words(self):
         '''
-        Get the stop words
+        Get the stop words: the English stop words of scikit-learn, imported
+        on the first call, and the custom ones
         '''
+        if self.__stop_words is None:
+            from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+            self.__stop_words = ENGLISH_STOP_WORDS.union(self.__custom_stop_words)
         return self.__stop_words
@@ -1,33 +1,54 @@
 import streamlit as st
-import wine_selector as ws
 import os
+from wine_selector_runtime import WineSelectorRuntime
 
 SRC_FILENAME = 'winemag-data-130k-v2.csv'
-DB_FILENAME = 'winemag-data-130k-v2-preprocessed.csv'
+CSV_FILENAME = 'winemag-data-130k-v2-preprocessed.csv'
+DB_FILENAME = 'winemag-data-130k-v2-preprocessed.store'
+# Query service shared by all the app processes, e.g. http://127.0.0.1:8765
+SERVICE_URL = os.environ.get('WINE_SELECTOR_URL')
 
 
-@st.cache_data()
+@st.cache_resource()
 def load_data():
     '''
     Load the data from the cache. If the data is not in the cache, load it 
-    rom the file and preprocess it
+    rom the file and preprocess it. The selector is a shared resource, so all
+    the sessions use the same data. If SERVICE_URL is set, the queries go to
+    the wine selector service and no data is loaded. Otherwise the queries
+    are answered by the lightweight runtime from the store, whose query cache
+    is shared by the sessions. The full selector is imported only to
+    preprocess the data and save the store
     '''
+    if SERVICE_URL:
+        from wine_selector_service import WineSelectorClient
+
+        return WineSelectorClient(SERVICE_URL)
+
+    try:
+        print("Loading preprocessed data...")
+        return WineSelectorRuntime(DB_FILENAME, n_similar=5)
+    except (OSError, ValueError):
+        pass
+
+    import wine_selector as ws
+
     # Create an instance of the WineSelector class
-    selector = ws.WineSelector(chunk_size=10000, n_similar=5)
+    selector = ws.WineSelector(chunk_size=10000, n_similar=5, compact=True)
 
     if os.path.exists(DB_FILENAME):
-        print("Loading preprocessed data...")
+        print("Updating preprocessed data...")
         selector.load_preprocessed_data(DB_FILENAME)
+    elif os.path.exists(CSV_FILENAME):
+        print("Loading preprocessed CSV data...")
+        selector.load_preprocessed_data(CSV_FILENAME)
     else:
         print("Preprocessing data...")
         selector.preprocess_data(SRC_FILENAME)
-        print("Saving preprocessed data...")
-        selector.save_preprocessed_data(DB_FILENAME)
+    print("Saving preprocessed data...")
+    selector.save_preprocessed_data(DB_FILENAME)
 
-    selector.get_data().drop_duplicates(
-        subset=['title', 'description', 'price', 'points'], inplace=True)
-
-    return selector
+    return WineSelectorRuntime(DB_FILENAME, n_similar=5)
 
 
 def get_type_filter():
@@ -56,6 +77,12 @@ def btn_click():
         result = st.session_state.data.select_wine(
             st.session_state.prompt, type_filter=type_filter,
             price_filter=price_filter)
+        # The runtime answers with the list of the wines, pandas is imported
+        # on the first search rather than when the app starts
+        if isinstance(result, list):
+            import pandas as pd
+
+            result = pd.DataFrame(result)
         st.session_state.result = result if not result.empty else None
 
 